@@ -1,4 +1,7 @@
-from .dataset import ECADataset, DataSource, AnnotationType
-from .scoring import content_area_hausdorff
+from .dataset import ECADataset, DataSource, AnnotationType, calculate_optimal_crop, calculate_optimal_crops
+from .view import DatasetView
+from .streaming import ShardStream
+from .sampler import Sampler
+from .scoring import content_area_hausdorff, content_area_hausdorff_batch
 from . import _version
 __version__ = _version.get_versions()['version']
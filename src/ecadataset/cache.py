@@ -0,0 +1,70 @@
+from collections import OrderedDict
+from threading import Lock
+from numpy import ndarray
+
+class ImageCache():
+    """
+    Least recently used cache of decoded images, bounded by a memory budget.
+
+    Hit, miss and eviction counts are kept in the `hits`, `misses` and `evictions` attributes.
+
+    Args:
+        max_bytes: memory budget of the cache in bytes.
+    """
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __reduce__(self):
+        # Cached images stay with the process that decoded them
+        return (ImageCache, (self.max_bytes,))
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry == None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, image):
+        size = image_nbytes(image)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (image, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+# ========================================
+# Some helper methods...
+
+def image_nbytes(image):
+    if isinstance(image, ndarray):
+        return image.nbytes
+    # PIL keeps multi-band images in 32 bit pixels
+    bands = len(image.getbands())
+    return image.width * image.height * (4 if bands > 1 else 1)
@@ -1,8 +1,16 @@
 from enum import Flag, auto
-from os import path
-from json import load
+from typing import Optional
+from os import path, replace, getpid
+from json import loads
+from hashlib import sha1
 from math import sqrt, floor
 from PIL import Image
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from .storage import PackedStore, BitMaskStore, open_store
+from .cache import ImageCache
+from .view import DatasetView
+from .index import SampleIndex
 
 class DataSource(Flag):
     """Flag to indicate origin dataset."""
@@ -16,16 +24,26 @@ class AnnotationType(Flag):
     MASK = auto()
     BOTH = AREA | MASK
 
-class ECADataset():
+class ECADataset(DatasetView):
     """
     Dataloader for the ECA dataset.
 
+    The dataset is itself a view over all of its samples, so slicing gives a lazy `DatasetView`.
+
     Args:
-        data_directory: root directory of the ECA data.
+        data_directory: root directory of the ECA data, or an uncompressed tar or zip archive of it.
         data_source: flag denoting the origin dataset(s) samples will be taken from.
         annotation_type: flag denoting the type of annotation(s) provided.
         include_cropped: whether or not to include additional cropped samples.
         include_source_info: whether or not to include the source information of the sample.
+        rebuild_index: whether or not to rebuild the cached sample index even if it is up to date.
+        packed_file: optional pack file, written by `ecadataset pack`, to serve decoded samples from.
+        packed_masks: optional bit-packed mask file, written by `ecadataset pack-masks`, to serve masks from.
+        cache_size: memory budget in bytes for caching decoded frames and masks, 0 disables the cache.
+        num_workers: number of threads used to decode batches of samples.
+        output: "pil" to return frames and masks as PIL images, or "numpy" for HWC uint8 frames and bool masks.
+        scale: factor, no greater than 1, to reduce the resolution of frames and masks by.
+        max_size: optional limit on the longest side of frames, applied on top of scale.
     """
     def __init__(
         self,
@@ -33,58 +51,124 @@ class ECADataset():
         data_source: DataSource = DataSource.BOTH,
         annotation_type: AnnotationType = AnnotationType.AREA,
         include_cropped: bool = True,
-        include_source_info: bool = False
+        include_source_info: bool = False,
+        rebuild_index: bool = False,
+        packed_file: Optional[str] = None,
+        packed_masks: Optional[str] = None,
+        cache_size: int = 0,
+        num_workers: int = 4,
+        output: str = "pil",
+        scale: float = 1.0,
+        max_size: Optional[int] = None
     ) -> None:
-        super().__init__()
         self.data_directory = data_directory
         self.annotation_type = annotation_type
         self.data_source = data_source
         self.include_cropped = include_cropped
         self.include_source_info = include_source_info
+        self.rebuild_index = rebuild_index
+        if output not in ("pil", "numpy"):
+            raise ValueError("Invalid output \"{}\"! Options are \"pil\" and \"numpy\".".format(output))
+        self.output = output
+        if not 0 < scale <= 1:
+            raise ValueError("Invalid scale {}! Scale must be greater than 0 and no greater than 1.".format(scale))
+        if max_size != None and max_size < 1:
+            raise ValueError("Invalid max_size {}! The max size must be at least 1.".format(max_size))
+        self.scale = scale
+        self.max_size = max_size
         try:
+            self.file_store = open_store(self.data_directory)
             self.sample_list = self.__get_sample_list()
         except FileNotFoundError:
             raise FileNotFoundError(ERROR_MESSAGE.format(path.abspath(self.data_directory)))
+        super().__init__(self, np.arange(len(self.sample_list)))
+
+        if packed_file == None:
+            self.store = self.file_store
+        else:
+            self.store = PackedStore(packed_file)
+            files = self.sample_list.image_files if packed_masks != None else [*self.sample_list.image_files, *self.sample_list.mask_files]
+            for file in files:
+                if file not in self.store:
+                    raise ValueError(PACK_ERROR_MESSAGE.format(path.abspath(packed_file)))
+
+        if packed_masks == None:
+            self.mask_store = self.store
+        else:
+            self.mask_store = BitMaskStore(packed_masks)
+            for file in self.sample_list.mask_files:
+                if file not in self.mask_store:
+                    raise ValueError(MASK_PACK_ERROR_MESSAGE.format(path.abspath(packed_masks)))
+        self.packed_masks = packed_masks
+
+        self.cache = ImageCache(cache_size) if cache_size > 0 else None
+        self.num_workers = num_workers
+        self.__executor = None
 
     def __get_sample_list(self):
-        sample_list = []
+        indices = []
 
         if DataSource.CHOLEC in self.data_source:
-            sample_list += get_sample_list(self.data_directory, DataSource.CHOLEC)
+            indices.append(get_sample_index(self.file_store, DataSource.CHOLEC, self.rebuild_index))
 
         if DataSource.ROBUST in self.data_source:
-            sample_list += get_sample_list(self.data_directory, DataSource.ROBUST)
+            indices.append(get_sample_index(self.file_store, DataSource.ROBUST, self.rebuild_index))
+
+        sample_list = SampleIndex.concatenate(indices)
 
         if self.include_cropped:
-            sample_list = add_cropped_samples(self.data_directory, sample_list)
+            sample_list = sample_list.with_crops()
 
         return sample_list
 
-    def __len__(self):
-        return len(self.sample_list)
+    def __get_scale(self, sample):
+        scale = self.scale
+        if self.max_size != None:
+            scale = min(scale, self.max_size / max(sample['frame_size']))
+        return scale
+
+    def __load_image(self, file, crop, size, mask, resized):
+        if mask and self.packed_masks != None and not resized:
+            # Unpacking straight from the mapped bits is cheaper than caching the unpacked mask
+            return self.mask_store.load_crop(file, crop)
 
-    def __getitem__(self, key):
+        image = None if self.cache == None else self.cache.get(file)
+        if image is None:
+            # Masks are not drafted, as reducing them in the DCT domain would blur their edges
+            store = self.mask_store if mask else self.store
+            image = store.load(file, None if mask else size)
+            if image_size(image) != size:
+                image = resize_image(image, size, mask)
+            if self.output == "numpy":
+                # Converting before cropping lets cropped samples be views of the full frame
+                image = mask_to_array(image) if mask else frame_to_array(image)
+                image.flags.writeable = False
+            if self.cache != None:
+                self.cache.put(file, image)
 
-        if isinstance(key, slice):
-            indices = range(*key.indices(len(self)))
-            return (self[i] for i in indices)
-            
+        if crop != None:
+            return crop_image(image, crop)
+        if self.cache != None and self.output == "pil" and isinstance(image, Image.Image):
+            # Cached images are shared, so hand out a copy
+            return image.copy()
+        return image
+
+    def __load(self, key, convert_frame, convert_mask):
         sample = self.sample_list[key]
+        scale = self.__get_scale(sample)
+        size = scaled_size(sample['frame_size'], scale)
+        crop = sample['crop'] if self.include_cropped else None
+        if crop != None and scale != 1:
+            crop = [round(value * scale) for value in crop]
         
-        frame = Image.open(path.join(self.data_directory, sample['image_file']))
-        frame.load()
-        if self.include_cropped and sample['crop'] != None:
-            frame = frame.crop(sample['crop'])
+        frame = convert_frame(self.__load_image(sample['image_file'], crop, size, False, scale != 1))
         result = (frame,)
 
         if AnnotationType.AREA in self.annotation_type:
-            result = (*result, sample['content_area'])
+            result = (*result, scale_circle(sample['content_area'], scale))
 
         if AnnotationType.MASK in self.annotation_type:
-            mask = Image.open(path.join(self.data_directory, sample['mask_file']))
-            mask.load()
-            if self.include_cropped and sample['crop'] != None:
-                mask = mask.crop(sample['crop'])
+            mask = convert_mask(self.__load_image(sample['mask_file'], crop, size, True, scale != 1))
             result = (*result, mask)
 
         if self.include_source_info:
@@ -92,6 +176,57 @@ class ECADataset():
 
         return result
 
+    def __getstate__(self):
+        # Worker threads stay with the process that created them
+        state = self.__dict__.copy()
+        state['_ECADataset__executor'] = None
+        return state
+
+    def _frame_sizes(self, rows):
+        index = self.sample_list
+        frame_sizes = index.frame_sizes[rows]
+        scales = np.full(len(frame_sizes), float(self.scale))
+        if self.max_size != None:
+            scales = np.minimum(scales, self.max_size / frame_sizes.max(axis=1, initial=1))
+        sizes = np.maximum(np.round(frame_sizes * scales[:, None]), 1)
+        crops = np.round(index.crops[rows] * scales[:, None])
+        crop_sizes = np.stack([crops[:, 3] - crops[:, 1], crops[:, 2] - crops[:, 0]], axis=1)
+        return np.where(index.has_crop[rows, None], crop_sizes, sizes).astype(np.int64)
+
+    def _get_executor(self):
+        if self.__executor == None:
+            self.__executor = ThreadPoolExecutor(self.num_workers)
+        return self.__executor
+
+    def _load_sample(self, key):
+        if self.output == "numpy":
+            return self.__load(key, frame_to_array, mask_to_array)
+        return self.__load(key, to_image, mask_to_image)
+
+    def load_into(self, key: int, out_frame: np.ndarray, out_mask: Optional[np.ndarray] = None):
+        """
+        Loads a sample into preallocated arrays rather than allocating new images.
+
+        The frame is written to the top left corner of `out_frame`, a uint8 array of at least (height, width, 3).
+        Likewise, the mask is written as zeros and ones into `out_mask`, a bool or uint8 array of at least
+        (height, width), or into a new bool array if `out_mask` is not given. Pack file samples are copied straight
+        from the memory map. Decoded files are not written in place, as PIL decodes into its own padded layout: the
+        decoded image is copied out to a temporary buffer by `np.asarray` and then into the output, so each call makes
+        two full-frame temporaries, and only the memory of the returned arrays is reused.
+
+        Args:
+            key: index of the sample to load.
+            out_frame: array to write the frame into.
+            out_mask: array to write the mask into.
+        Returns:
+            tuple: the sample as in numpy output mode, with views of the written regions of the arrays.
+        """
+        return self.__load(
+            key,
+            lambda image: write_frame(image, out_frame),
+            lambda image: mask_to_array(image) if out_mask is None else write_mask(image, out_mask)
+        )
+
 # ========================================
 # Some helper methods...
 
@@ -101,18 +236,101 @@ Some of the requested data cannot be found at path \"{}\"...
 Please provide the correct path to the dataset, or download the dataset with the command \"download-eca\"...
 """
 
+PACK_ERROR_MESSAGE = """
+The pack file \"{}\" does not contain all of the requested samples...
+Please recreate it for this dataset with the command \"ecadataset pack\"...
+"""
+
+MASK_PACK_ERROR_MESSAGE = """
+The mask file \"{}\" does not contain all of the requested masks...
+Please recreate it for this dataset with the command \"ecadataset pack-masks\"...
+"""
+
 dataset_info = {
     DataSource.CHOLEC: {"name": "cholec-eca", "pretty_name": "CholecECA", "synapse_id": "syn32150390"},
     DataSource.ROBUST: {"name": "robust-eca", "pretty_name": "RobustECA", "synapse_id": "syn32150393"}
 }
 
-def get_sample_list(data_directory, dataset_source):
+INDEX_VERSION = 2
+
+def get_sample_index(store, dataset_source, rebuild_index=False):
     info = dataset_info[dataset_source]
-    dataset_path = path.join(data_directory, info['name'])
-    with open(path.join(dataset_path, "manifest.json")) as file:
-        return load(file)
+    manifest_file = info['name'] + "/manifest.json"
+    index_file = store.sidecar(info['name'] + "/index.npz")
+
+    if not rebuild_index:
+        index = load_index(index_file, store, manifest_file)
+        if index != None:
+            return index
+
+    index = build_index(store, manifest_file, dataset_source)
+    save_index(index_file, store, manifest_file, index)
+    return index
+
+def get_manifest_hash(store, manifest_file):
+    return sha1(store.read(manifest_file)).hexdigest()
+
+def load_index(index_file, store, manifest_file):
+    manifest_mtime, manifest_size = store.stat(manifest_file)
+    try:
+        with np.load(index_file, allow_pickle=False) as arrays:
+            if 'version' not in arrays or arrays['version'] != INDEX_VERSION:
+                return None
+            mtime, size, manifest_hash = arrays['manifest_mtime'], arrays['manifest_size'], arrays['manifest_hash']
+            index = SampleIndex(**arrays)
+    except (OSError, ValueError, KeyError):
+        return None
+
+    if mtime != manifest_mtime or size != manifest_size:
+        # The manifest has been touched, only rebuild if its content actually changed
+        if manifest_hash != get_manifest_hash(store, manifest_file):
+            return None
+        save_index(index_file, store, manifest_file, index)
+
+    return index
+
+def build_index(store, manifest_file, dataset_source):
+    index = SampleIndex.from_manifest(loads(store.read(manifest_file)), dataset_source.value)
+    with ThreadPoolExecutor() as executor:
+        frame_sizes = list(executor.map(lambda file: read_frame_size(store, file), index.image_files.tolist()))
+    index.frame_sizes = np.array(frame_sizes, dtype=np.int32).reshape(-1, 2)[index.image_codes]
+    has_area = index.has_area
+    index.optimal_crops[has_area] = calculate_optimal_crops(index.circles[has_area], index.frame_sizes[has_area, ::-1])
+    return index
+
+def read_frame_size(store, file):
+    # Opening an image only reads its header
+    with store.open(file) as image:
+        return image.height, image.width
+
+def save_index(index_file, store, manifest_file, index):
+    manifest_mtime, manifest_size = store.stat(manifest_file)
+    temp_file = "{}.{}.tmp".format(index_file, getpid())
+    try:
+        with open(temp_file, "wb") as file:
+            np.savez(
+                file,
+                version=INDEX_VERSION,
+                manifest_mtime=manifest_mtime,
+                manifest_size=manifest_size,
+                manifest_hash=get_manifest_hash(store, manifest_file),
+                **index.columns()
+            )
+        replace(temp_file, index_file)
+    except OSError:
+        # Read-only copies of the dataset simply rebuild the index in memory
+        pass
 
 def calculate_optimal_crop(circle, rectangle):
+    """
+    Largest crop, with the aspect ratio of the frame, lying within both a content area and the frame.
+
+    Args:
+        circle: content area circle as (x, y, r).
+        rectangle: frame size as (width, height).
+    Returns:
+        tuple: the crop as (left, top, right, bottom).
+    """
 
     r_w, r_h = rectangle
     c_x, c_y, c_r = circle
@@ -140,15 +358,117 @@ def calculate_optimal_crop(circle, rectangle):
 
     return x, y, x+w, y+h
 
-def add_cropped_samples(data_directory, samples):
-    new_samples = []
-    for sample in samples:
-        sample['crop'] = None
-        new_samples.append(sample.copy())
-        if sample['content_area'] != None:
-            with Image.open(path.join(data_directory, sample['mask_file'])) as image:
-                image_size = image.size
-            sample['crop'] = calculate_optimal_crop(sample['content_area'], image_size)
-            sample['content_area'] = None
-            new_samples.append(sample)
-    return new_samples
+def calculate_optimal_crops(circles: np.ndarray, rectangles: np.ndarray) -> np.ndarray:
+    """
+    Vectorised version of `calculate_optimal_crop`, giving identical results.
+
+    Args:
+        circles: (N, 3) array of content area circles as (x, y, r).
+        rectangles: (N, 2) array of frame sizes as (width, height).
+    Returns:
+        np.ndarray: (N, 4) array of crops as (left, top, right, bottom).
+    """
+    circles = np.asarray(circles, dtype=np.float64).reshape(-1, 3)
+    rectangles = np.asarray(rectangles, dtype=np.float64).reshape(-1, 2)
+
+    r_w, r_h = rectangles.T
+    c_x, c_y, c_r = circles.T
+
+    aspect_ratio = r_w / r_h
+
+    inscribed_height = 2 * (c_r - 2) / np.sqrt(1 + aspect_ratio * aspect_ratio)
+    inscribed_width = inscribed_height * aspect_ratio
+
+    left = np.maximum(c_x - inscribed_width / 2, 0)
+    right = np.minimum(c_x + inscribed_width / 2, r_w)
+    top = np.maximum(c_y - inscribed_height / 2, 0)
+    bottom = np.minimum(c_y + inscribed_height / 2, r_h)
+
+    x_scale = (right - left)
+    y_scale = (bottom - top) * aspect_ratio
+
+    scale = np.minimum(x_scale, y_scale)
+
+    w = np.floor(scale)
+    h = np.floor(scale / aspect_ratio)
+
+    # int() truncates towards zero
+    x = np.trunc(left + (right - left) / 2 - w / 2)
+    y = np.trunc(top + (bottom - top) / 2 - h / 2)
+
+    return np.stack([x, y, x+w, y+h], axis=1).astype(np.int64)
+
+def crop_image(image, crop):
+    if isinstance(image, np.ndarray):
+        left, top, right, bottom = crop
+        return image[top:bottom, left:right]
+    return image.crop(crop)
+
+def image_size(image):
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return image.size
+
+def scaled_size(frame_size, scale):
+    height, width = frame_size
+    return max(round(width * scale), 1), max(round(height * scale), 1)
+
+def scale_circle(circle, scale):
+    if circle == None or scale == 1:
+        return circle
+    return [round(value * scale) for value in circle]
+
+def resize_image(image, size, mask):
+    if mask:
+        return mask_to_image(image).resize(size, Image.NEAREST)
+    image = to_image(image)
+    # The reducing gap lets PIL take its fast integer reduce() path for most of the downscaling
+    return image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+
+def to_image(image):
+    if isinstance(image, np.ndarray):
+        return Image.fromarray(image)
+    return image
+
+def mask_to_image(image):
+    if isinstance(image, np.ndarray) and image.dtype == bool:
+        # Unpacked masks are given as "L" images of 0 and 255, like the mask files, rather than as "1" images
+        return Image.fromarray(image.view(np.uint8) * np.uint8(255))
+    return to_image(image)
+
+def frame_to_array(image):
+    if isinstance(image, np.ndarray):
+        return image
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.asarray(image)
+
+def mask_values(image):
+    if isinstance(image, np.ndarray):
+        return image
+    if image.mode not in ("1", "L"):
+        image = image.convert("L")
+    return np.asarray(image)
+
+def mask_to_array(image):
+    if isinstance(image, np.ndarray) and image.dtype == bool:
+        return image
+    return mask_values(image) > 0
+
+def out_region(out, shape):
+    height, width = shape[:2]
+    if out.shape[0] < height or out.shape[1] < width:
+        raise ValueError("Output array of shape {} is too small for a sample of shape {}.".format(out.shape, shape))
+    return out[:height, :width]
+
+def write_frame(image, out):
+    array = frame_to_array(image)
+    region = out_region(out, array.shape)
+    np.copyto(region, array)
+    return region
+
+def write_mask(image, out):
+    array = mask_values(image)
+    region = out_region(out, array.shape)
+    np.greater(array, 0, out=region)
+    return region
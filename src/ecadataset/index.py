@@ -0,0 +1,137 @@
+import numpy as np
+
+class SampleIndex():
+    """
+    Columnar index of sample metadata.
+
+    File paths and source names are held once each in tables of unique strings, referenced from each sample by
+    an integer code, and all other metadata is held in numpy arrays. This keeps the index compact, with no
+    per-sample Python objects to be duplicated in forked processes. Indexing with an integer gives a record of
+    the sample as a dict, in the same form as the manifest, and slicing gives the index of those samples.
+
+    Columns:
+        image_files, mask_files, source_names, video_names: tables of unique strings.
+        image_codes, mask_codes, source_codes, video_codes: (N,) int32 codes into the tables.
+        frame_numbers: (N,) int32 frame number within the source video.
+        data_sources: (N,) uint8 value of the DataSource flag for the sample's origin dataset.
+        circles: (N, 3) int32 content area circles as (x, y, r), zero where there is no content area.
+        has_area: (N,) bool whether the sample has a content area.
+        frame_sizes: (N, 2) int32 frame sizes as (height, width).
+        optimal_crops: (N, 4) int32 optimal crop within the content area, zero where there is none.
+        crops: (N, 4) int32 crop applied to the sample as (left, top, right, bottom), zero where uncropped.
+        has_crop: (N,) bool whether the sample is cropped.
+    """
+    TABLES = (
+        ("image_files", "image_codes"),
+        ("mask_files", "mask_codes"),
+        ("source_names", "source_codes"),
+        ("video_names", "video_codes"),
+    )
+    ROWS = (
+        "image_codes", "mask_codes", "source_codes", "video_codes", "frame_numbers", "data_sources",
+        "circles", "has_area", "frame_sizes", "optimal_crops", "crops", "has_crop",
+    )
+
+    def __init__(self, **columns) -> None:
+        for table, _ in self.TABLES:
+            setattr(self, table, columns[table])
+        for row in self.ROWS:
+            setattr(self, row, columns[row])
+
+    def __len__(self):
+        return len(self.image_codes)
+
+    def __iter__(self):
+        for key in range(len(self)):
+            yield self[key]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.take(key)
+        return {
+            'image_file': str(self.image_files[self.image_codes[key]]),
+            'mask_file': str(self.mask_files[self.mask_codes[key]]),
+            'content_area': self.circles[key].tolist() if self.has_area[key] else None,
+            'source_info': [
+                str(self.source_names[self.source_codes[key]]),
+                str(self.video_names[self.video_codes[key]]),
+                int(self.frame_numbers[key])
+            ],
+            'frame_size': self.frame_sizes[key].tolist(),
+            'optimal_crop': self.optimal_crops[key].tolist() if self.has_area[key] else None,
+            'crop': self.crops[key].tolist() if self.has_crop[key] else None,
+        }
+
+    def columns(self):
+        return {name: getattr(self, name) for name in [*(table for table, _ in self.TABLES), *self.ROWS]}
+
+    def take(self, rows):
+        """
+        Index of the samples at the given rows, sharing the string tables.
+        """
+        columns = self.columns()
+        for row in self.ROWS:
+            columns[row] = columns[row][rows]
+        return SampleIndex(**columns)
+
+    def with_crops(self):
+        """
+        Index with an additional cropped sample, without a content area, following each sample which has one.
+        """
+        rows = np.repeat(np.arange(len(self)), np.where(self.has_area, 2, 1))
+        index = self.take(rows)
+        is_crop = np.zeros(len(rows), dtype=bool)
+        is_crop[1:] = rows[1:] == rows[:-1]
+        index.crops = np.where(is_crop[:, None], index.optimal_crops, 0).astype(np.int32)
+        index.has_crop = is_crop
+        index.has_area = index.has_area & ~is_crop
+        index.circles = np.where(index.has_area[:, None], index.circles, 0).astype(np.int32)
+        return index
+
+    @staticmethod
+    def from_manifest(samples, data_source):
+        """
+        Index of the samples listed in a manifest, with zeroed frame sizes and optimal crops.
+        """
+        columns = {}
+        columns['image_files'], columns['image_codes'] = intern([sample['image_file'] for sample in samples])
+        columns['mask_files'], columns['mask_codes'] = intern([sample['mask_file'] for sample in samples])
+        columns['source_names'], columns['source_codes'] = intern([sample['source_info'][0] for sample in samples])
+        columns['video_names'], columns['video_codes'] = intern([sample['source_info'][1] for sample in samples])
+        columns['frame_numbers'] = np.array([sample['source_info'][2] for sample in samples], dtype=np.int32)
+        columns['data_sources'] = np.full(len(samples), data_source, dtype=np.uint8)
+        columns['has_area'] = np.array([sample['content_area'] != None for sample in samples], dtype=bool)
+        columns['circles'] = np.array([
+            sample['content_area'] if sample['content_area'] != None else (0, 0, 0) for sample in samples
+        ], dtype=np.int32).reshape(-1, 3)
+        columns['frame_sizes'] = np.zeros((len(samples), 2), dtype=np.int32)
+        columns['optimal_crops'] = np.zeros((len(samples), 4), dtype=np.int32)
+        columns['crops'] = np.zeros((len(samples), 4), dtype=np.int32)
+        columns['has_crop'] = np.zeros(len(samples), dtype=bool)
+        return SampleIndex(**columns)
+
+    @staticmethod
+    def concatenate(indices):
+        """
+        Index of the samples of several indices, merging their string tables.
+        """
+        if len(indices) == 1:
+            return indices[0]
+        columns = {}
+        for table, codes in SampleIndex.TABLES:
+            tables = [getattr(index, table) for index in indices]
+            offsets = np.cumsum([0, *map(len, tables)])
+            columns[table], inverse = np.unique(np.concatenate(tables), return_inverse=True)
+            inverse = inverse.astype(np.int32)
+            columns[codes] = np.concatenate([inverse[offset + getattr(index, codes)] for offset, index in zip(offsets, indices)])
+        for row in SampleIndex.ROWS:
+            if row not in columns:
+                columns[row] = np.concatenate([getattr(index, row) for index in indices])
+        return SampleIndex(**columns)
+
+# ========================================
+# Some helper methods...
+
+def intern(strings):
+    table, codes = np.unique(np.array(strings, dtype=str), return_inverse=True)
+    return table, codes.astype(np.int32).reshape(-1)
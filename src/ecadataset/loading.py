@@ -0,0 +1,263 @@
+import numpy as np
+from os import path, makedirs, listdir, remove, getpid, kill
+from json import loads, dumps
+from tempfile import gettempdir
+from asyncio import get_running_loop
+from warnings import warn
+from collections import deque, namedtuple
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+
+def resolve_indices(key, length):
+    """
+    Converts a list, integer array or boolean mask into an array of non-negative sample indices.
+    """
+    indices = np.asarray(key)
+
+    if indices.dtype == bool:
+        if indices.shape != (length,):
+            raise IndexError("Boolean index of shape {} does not match dataset of length {}.".format(indices.shape, length))
+        return np.flatnonzero(indices)
+
+    if indices.size == 0:
+        return np.zeros(0, dtype=np.intp)
+
+    if indices.ndim != 1 or not np.issubdtype(indices.dtype, np.integer):
+        raise IndexError("Only integers, slices, and 1D integer or boolean arrays are valid indices.")
+
+    indices = np.where(indices < 0, indices + length, indices)
+    if np.any((indices < 0) | (indices >= length)):
+        raise IndexError("Index out of range for dataset of length {}.".format(length))
+
+    return indices
+
+def load_batch(load, indices, executor):
+    """
+    Loads samples on a pool of threads, returning them in the order of the indices.
+    """
+    return list(executor.map(load, indices.tolist()))
+
+def prefetch_samples(load, keys, prefetch, workers):
+    """
+    Generator which loads samples ahead of the consumer on a pool of threads.
+
+    Keys may be any iterable, such as indices or records read from a stream, and are only consumed as loads are
+    submitted. At most `prefetch` samples are loaded or waiting at any time, and they are yielded in the order of
+    the keys. Errors are raised when the failing sample is reached, and abandoning the generator cancels any
+    pending loads.
+    """
+    executor = ThreadPoolExecutor(workers)
+    keys = iter(keys)
+    pending = deque(executor.submit(load, key) for key in islice(keys, max(prefetch, 1)))
+    try:
+        while len(pending) > 0:
+            future = pending.popleft()
+            for key in islice(keys, 1):
+                pending.append(executor.submit(load, key))
+            yield future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+async def stream_samples(load, keys, concurrency, executor):
+    """
+    Async generator which loads samples on an executor, without blocking the event loop.
+
+    At most `concurrency` samples are loaded or waiting at any time, and they are yielded in the order of the keys.
+    Closing the generator, or cancelling the task consuming it, cancels any loads which have not yet started.
+    """
+    loop = get_running_loop()
+    keys = iter(keys)
+    pending = deque(loop.run_in_executor(executor, load, key) for key in islice(keys, max(concurrency, 1)))
+    try:
+        while len(pending) > 0:
+            future = pending.popleft()
+            for key in islice(keys, 1):
+                pending.append(loop.run_in_executor(executor, load, key))
+            yield await future
+    finally:
+        for future in pending:
+            future.cancel()
+
+class SharedMemoryLoader():
+    """
+    Loads samples on a pool of worker processes which write them into shared memory slots.
+
+    Only indices and small metadata are sent between processes. Workers load with `ECADataset.load_into`, which
+    copies packed samples straight into a slot but passes decoded files through two full-frame temporaries in the
+    worker. Frames and masks are returned as numpy arrays backed by a slot, which is reused once the following
+    sample is requested, so copy any arrays that need to be kept. The loader should be closed, or used as a context manager, to release its workers and memory. A loader
+    which is garbage collected unclosed warns and releases its memory, and the segments of a process which died
+    without closing its loaders are found, from the names each loader records in a sidecar file, and released by
+    the next loader to be created.
+
+    Args:
+        dataset: the ECADataset to load samples from.
+        workers: number of worker processes.
+        slots: number of shared memory slots, limiting how many samples are loaded ahead of the consumer.
+    """
+    def __init__(self, dataset, workers: int, slots: int) -> None:
+        frame_shape = tuple(dataset.sample_list.frame_sizes.max(axis=0, initial=1).tolist())
+        capacity = slot_capacity(frame_shape)
+        leaked = release_stale_segments()
+        if len(leaked) > 0:
+            warn("Released shared memory segments leaked by an earlier process: {}.".format(", ".join(leaked)), ResourceWarning)
+
+        self.segments = [SharedMemory(create=True, size=capacity) for _ in range(max(slots, 1))]
+        self.segment_names = [segment.name for segment in self.segments]
+        self.registry_file = register_segments(self.segment_names)
+        self.pool = get_context().Pool(workers, initializer=init_worker, initargs=(dataset, self.segment_names, frame_shape))
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        if not getattr(self, 'closed', True):
+            warn("SharedMemoryLoader was not closed, releasing its shared memory.", ResourceWarning)
+            self.close()
+
+    def load(self, indices):
+        """
+        Generator yielding the samples at the given indices, in order.
+        """
+        indices = iter(indices.tolist())
+        free_slots = deque(range(len(self.segments)))
+        pending = deque()
+
+        def submit():
+            for index in islice(indices, len(free_slots)):
+                slot = free_slots.popleft()
+                pending.append((slot, self.pool.apply_async(load_into_slot, (slot, index))))
+
+        submit()
+        while len(pending) > 0:
+            slot, result = pending.popleft()
+            sample = result.get()
+            yield tuple(read_from_slot(item, self.segments[slot].buf) for item in sample)
+            free_slots.append(slot)
+            submit()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pool.terminate()
+        self.pool.join()
+        for segment in self.segments:
+            try:
+                segment.close()
+            except BufferError:
+                # Arrays handed out are still alive, the mapping is freed along with them
+                pass
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                # Released elsewhere, the remaining segments must still be released
+                pass
+        try:
+            remove(self.registry_file)
+        except OSError:
+            pass
+
+# ========================================
+# Some helper methods...
+
+SLOT_ALIGNMENT = 64
+
+SlotArray = namedtuple("SlotArray", ["offset", "shape", "strides", "dtype"])
+
+worker_state = {}
+
+def slot_capacity(frame_shape):
+    height, width = frame_shape
+    frame_bytes = height * width * 3
+    return frame_bytes + (-frame_bytes % SLOT_ALIGNMENT) + height * width
+
+def slot_arrays(buffer, frame_shape):
+    height, width = frame_shape
+    frame_bytes = height * width * 3
+    frame = np.ndarray((height, width, 3), np.uint8, buffer, 0)
+    mask = np.ndarray((height, width), bool, buffer, frame_bytes + (-frame_bytes % SLOT_ALIGNMENT))
+    return frame, mask
+
+def init_worker(dataset, segment_names, frame_shape):
+    worker_state['dataset'] = dataset
+    worker_state['segments'] = [SharedMemory(name) for name in segment_names]
+    worker_state['slots'] = [slot_arrays(segment.buf, frame_shape) for segment in worker_state['segments']]
+
+def load_into_slot(slot, index):
+    frame, mask = worker_state['slots'][slot]
+    base = frame.__array_interface__['data'][0]
+    sample = worker_state['dataset'].load_into(index, frame, mask)
+    return tuple(
+        SlotArray(item.__array_interface__['data'][0] - base, item.shape, item.strides, item.dtype.str)
+        if isinstance(item, np.ndarray) else item
+        for item in sample
+    )
+
+def read_from_slot(item, buffer):
+    if isinstance(item, SlotArray):
+        return np.ndarray(item.shape, item.dtype, buffer, item.offset, item.strides)
+    return item
+
+def find_leaked_segments(segment_names):
+    leaked = []
+    for name in segment_names:
+        try:
+            segment = SharedMemory(name)
+        except FileNotFoundError:
+            continue
+        segment.close()
+        segment.unlink()
+        leaked.append(name)
+    return leaked
+
+SEGMENT_REGISTRY = path.join(gettempdir(), "ecadataset-shared-memory")
+
+def register_segments(segment_names):
+    makedirs(SEGMENT_REGISTRY, exist_ok=True)
+    registry_file = path.join(SEGMENT_REGISTRY, "{}-{}.json".format(getpid(), segment_names[0]))
+    with open(registry_file, "w") as file:
+        file.write(dumps(segment_names))
+    return registry_file
+
+def release_stale_segments():
+    """
+    Releases the segments recorded by loaders of processes which are no longer running, returning their names.
+    """
+    try:
+        registry_files = listdir(SEGMENT_REGISTRY)
+    except FileNotFoundError:
+        return []
+
+    leaked = []
+    for registry_file in registry_files:
+        try:
+            pid, _ = registry_file.split("-", 1)
+            if not registry_file.endswith(".json") or process_running(int(pid)):
+                continue
+            with open(path.join(SEGMENT_REGISTRY, registry_file)) as file:
+                leaked += find_leaked_segments(loads(file.read()))
+            remove(path.join(SEGMENT_REGISTRY, registry_file))
+        except (OSError, OverflowError, TypeError, ValueError):
+            # Files which are not a loader's, or are being released by another loader, are skipped
+            pass
+    return leaked
+
+def process_running(pid):
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def iterate_shared_memory(dataset, indices, prefetch, workers):
+    with SharedMemoryLoader(dataset, workers, prefetch) as loader:
+        yield from loader.load(indices)
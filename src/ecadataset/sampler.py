@@ -0,0 +1,101 @@
+from typing import Optional
+from .loading import prefetch_samples
+
+class Sampler():
+    """
+    Resumable iterator over the samples of a view, in a shuffled and sharded order.
+
+    The order of each epoch is drawn from the seed and the epoch number, so the state of the sampler is only the
+    epoch and the position within it. Saving and restoring the state is O(1), and a restored sampler resumes
+    straight from its position without reading or skipping through the samples before it. Shuffling is done over
+    groups of samples of the same frame, as with `DatasetView.shard`.
+
+    Iterating the sampler gives indices into the dataset, and `samples` gives the loaded samples. The position
+    counts the samples handed out, and finishing an epoch moves the sampler on to the next.
+
+    Args:
+        view: the ECADataset, or a view of it, to sample.
+        shuffle: whether to shuffle the samples of each epoch.
+        seed: seed of the shuffling, shared by all ranks.
+        rank: index of the partition of the samples to iterate.
+        world_size: number of partitions.
+    """
+    def __init__(self, view, shuffle: bool = True, seed: int = 0, rank: int = 0, world_size: int = 1) -> None:
+        self.view = view
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.position = 0
+        self.__order = None
+
+    def __len__(self):
+        return len(self.indices())
+
+    def __iter__(self):
+        indices = self.indices()
+        while self.position < len(indices):
+            self.position += 1
+            yield int(indices[self.position - 1])
+        self.set_epoch(self.epoch + 1)
+
+    def indices(self):
+        """
+        Indices into the dataset of all of the samples of the current epoch, in order.
+        """
+        if self.__order == None or self.__order[0] != self.epoch:
+            seed = [self.seed, self.epoch] if self.shuffle else None
+            self.__order = (self.epoch, self.view.shard(self.rank, self.world_size, seed).indices)
+        return self.__order[1]
+
+    def samples(self, prefetch: int = 8, workers: Optional[int] = None):
+        """
+        Iterates over the remaining samples of the epoch, loading them ahead of the consumer on a pool of threads.
+
+        Args:
+            prefetch: maximum number of samples loaded ahead of the consumer.
+            workers: number of loading threads, defaults to the dataset's `num_workers`.
+        """
+        dataset = self.view.dataset
+        workers = dataset.num_workers if workers == None else workers
+        samples = prefetch_samples(dataset._load_sample, self.indices()[self.position:].tolist(), prefetch, workers)
+        try:
+            for sample in samples:
+                self.position += 1
+                yield sample
+        finally:
+            samples.close()
+        self.set_epoch(self.epoch + 1)
+
+    def set_epoch(self, epoch: int):
+        """
+        Moves the sampler to the start of an epoch.
+        """
+        self.epoch = epoch
+        self.position = 0
+
+    def state_dict(self):
+        """
+        State of the sampler, as a dict of plain values.
+        """
+        return {
+            'seed': self.seed,
+            'shuffle': self.shuffle,
+            'rank': self.rank,
+            'world_size': self.world_size,
+            'length': len(self.view),
+            'epoch': self.epoch,
+            'position': self.position,
+        }
+
+    def load_state_dict(self, state):
+        """
+        Restores the state of the sampler, which must sample the same view with the same settings as when saved.
+        """
+        settings = {'seed': self.seed, 'shuffle': self.shuffle, 'rank': self.rank, 'world_size': self.world_size, 'length': len(self.view)}
+        for key, value in settings.items():
+            if state[key] != value:
+                raise ValueError("Sampler state was saved with {} {}, but this sampler has {}.".format(key, state[key], value))
+        self.epoch = state['epoch']
+        self.position = state['position']
@@ -1,87 +1,75 @@
 import numpy as np
-from typing import Sequence, Optional, Tuple
-
-class Line():
-    def __init__(self, a, b) -> None:
-        self.a = np.array(a)
-        self.b = np.array(b)
-        self.v = self.b - self.a
-        self.l = np.linalg.norm(self.v)
-        self.u = self.v / self.l
-    
-    def get_length(self):
-        return self.l
-
-    def get_point(self, t):
-        return self.a + t * self.l * self.u
-
-    def get_closest_point(self, p):
-        v = p - self.a
-        d = np.dot(v, self.u)
-        d = max(0, min(d, self.l))
-        return self.a + d * self.u
-
-class Circle():
-    def __init__(self, c, r) -> None:
-        self.c = np.array(c)
-        self.r = r
-
-    def get_length(self):
-        return 2 * np.pi * self.r
-
-    def get_point(self, t):
-        angle = t * 2 * np.pi
-        x = np.cos(angle) * self.r
-        y = np.sin(angle) * self.r
-        return self.c + np.array([x, y])
-
-    def get_closest_point(self, p):
-        v = p - self.c
-        u = v / np.linalg.norm(v)
-        return self.c + self.r * u
-
-class Arc():
-    def __init__(self, c, r, s, e) -> None:
-        self.c = np.array(c)
-        self.r = r
-        self.s = np.array(s)
-        self.e = np.array(e)
-        self.a = self.get_angle(self.e)
-
-    def get_angle(self, p):
-        v = p - self.c
-        u = self.s - self.c
-        angle = np.arctan2(v[1], v[0]) - np.arctan2(u[1], u[0])
-        if angle < 0: angle += 2 * np.pi
-        return angle
-        
-    def get_length(self):
-        return self.a * self.r
-
-    def get_point(self, t):
-        angle = t * self.a
-        v = self.s - self.c
-        x = np.cos(angle) * v[0] - np.sin(angle) * v[1]
-        y = np.sin(angle) * v[0] + np.cos(angle) * v[1]
-        return self.c + np.array([x, y])
-    
-    def get_closest_point(self, p):
-        angle = self.get_angle(p)
-        angle = max(0, min(angle, self.a))
-        return self.get_point(angle / self.a)
+from math import atan2
+from typing import Sequence, Optional, Tuple, Union
+
+LINE, ARC = 0, 1
+
+SEGMENT_DTYPE = np.dtype([
+    ('kind', np.uint8),
+    ('start', np.float64, 2),
+    ('end', np.float64, 2),
+    ('centre', np.float64, 2),
+    ('radius', np.float64),
+    ('angle', np.float64),
+])
+
+class Boundary():
+    """
+    Boundary of a content area, as a structured array of segment records.
+
+    Each record is a line or an arc, with its start and end points, and for arcs the centre, radius and angle turned
+    from the start to the end. A full circle is an arc of 2 pi from its rightmost point.
+
+    Args:
+        segments: (S,) array of SEGMENT_DTYPE records.
+    """
+    __slots__ = ("segments",)
+
+    def __init__(self, segments: np.ndarray) -> None:
+        self.segments = segments
+
+    def __len__(self):
+        return len(self.segments)
+
+    def get_lengths(self):
+        """
+        (S,) lengths of the segments.
+        """
+        segments = self.segments
+        lines = np.hypot(*(segments['end'] - segments['start']).T)
+        return np.where(segments['kind'] == LINE, lines, segments['angle'] * segments['radius'])
+
+    def get_points(self, t):
+        """
+        Points at fractions t along the segments, as an (..., S, 2) array for t broadcasting to the shape (..., S).
+        """
+        segments = self.segments
+        t = np.asarray(t, dtype=np.float64)[..., None]
+        lines = segments['start'] + t * (segments['end'] - segments['start'])
+        arcs = get_arc_points(segments['centre'], segments['start'], t[..., 0] * segments['angle'])
+        return np.where((segments['kind'] == LINE)[:, None], lines, arcs)
+
+    def get_closest_points(self, points):
+        """
+        Closest points on each segment to each of an (..., 2) array of points, as an (..., S, 2) array.
+        """
+        return get_closest_points(self.get_arrays()[:6], np.asarray(points, dtype=np.float64)[..., None, :])
+
+    def get_arrays(self):
+        """
+        The fields of the records as separate contiguous arrays, with a mask of which segments are lines.
+        """
+        fields = (self.segments[name] for name in ('start', 'end', 'centre', 'radius', 'angle'))
+        return (*map(np.ascontiguousarray, fields), self.segments['kind'] == LINE)
 
 def make_polygon(frame_size, circle):
 
     h, w = frame_size
 
     if circle == None:
-        polygon = [
-            Line((0,0), (w,0)),
-            Line((w,0), (w,h)),
-            Line((w,h), (0,h)),
-            Line((0,h), (0,0)),
-        ]
-        return polygon
+        corners = [(0, 0), (w, 0), (w, h), (0, h)]
+        polygon = [(LINE, s, e, (0, 0), 0, 0) for s, e in zip(corners, corners[1:] + corners[:1])]
+        return Boundary(np.array(polygon, dtype=SEGMENT_DTYPE))
 
     x, y, r = circle
 
@@ -125,10 +113,8 @@ def make_polygon(frame_size, circle):
         intersections.append((0, 0)); is_line.append(True)
 
     if len(intersections) == 0:
-        polygon = [
-            Circle((x, y), r)
-        ]
-        return polygon
+        polygon = [(ARC, (x + r, y), (x + r, y), (x, y), r, 2 * np.pi)]
+        return Boundary(np.array(polygon, dtype=SEGMENT_DTYPE))
 
     start = intersections
     end = intersections[1:] + intersections[:1]
@@ -136,55 +122,534 @@ def make_polygon(frame_size, circle):
     polygon = []
     for s, e, line in zip(start, end, is_line):
         if line:
-            segment = Line(s, e)
+            segment = (LINE, s, e, (0, 0), 0, 0)
         else:
-            segment = Arc((x, y), r, s, e)
+            angle = atan2(e[1] - y, e[0] - x) - atan2(s[1] - y, s[0] - x)
+            if angle < 0: angle += 2 * np.pi
+            segment = (ARC, s, e, (x, y), r, angle)
         polygon.append(segment)
 
-    return polygon
+    return Boundary(np.array(polygon, dtype=SEGMENT_DTYPE))
 
-def get_polygon_points(polygon, n_points):
+def get_segment_arrays(polygons):
+    """
+    Arrays describing the segments of several boundaries, as the fields of their records.
 
-    lengths = [seg.get_length() for seg in polygon]
-    total_length = sum(lengths)
+    Returns:
+        tuple: (S, 2) start points, (S, 2) end points, (S, 2) centres, (S,) radii, (S,) arc angles, a (S,) mask of
+            which segments are lines, and the (S,) index of the polygon each segment belongs to.
+    """
+    segments = Boundary(np.concatenate([polygon.segments for polygon in polygons]))
+    owners = np.repeat(np.arange(len(polygons)), [len(polygon) for polygon in polygons])
+    return (*segments.get_arrays(), owners)
 
-    step = total_length / n_points
-    
-    points = []
+def get_polygon_points(segments, n_points):
+    """
+    Points spaced along the arcs of each polygon, and the ends of their lines, with the polygon of each point.
+    """
+    starts, ends, centres, radii, angles, is_line, owners = segments
+    lengths = np.where(is_line, np.hypot(ends[:, 0] - starts[:, 0], ends[:, 1] - starts[:, 1]), angles * radii)
+    total_lengths = np.bincount(owners, weights=lengths)
+
+    step = total_lengths[owners] / n_points
+
+    # No need to discretise lines, final point pair 
+    # will never be in the middle of the line
+    seg_numbers = np.where(is_line, 0, lengths // step)
+    counts = np.where(is_line, 1, seg_numbers).astype(np.int64)
+
+    seg = np.repeat(np.arange(len(counts)), counts)
+    i = seg_numbers[seg] - (np.arange(len(seg)) - (np.cumsum(counts) - counts)[seg])
+    t = np.divide(i, seg_numbers[seg], out=np.zeros(len(seg)), where=~is_line[seg])
+
+    points = get_arc_points(centres[seg], starts[seg], t * angles[seg])
+    return np.where(is_line[seg, None], ends[seg], points), owners[seg]
+
+def get_arc_points(centres, starts, angles):
+    v = starts - centres
+    cos, sin = np.cos(angles), np.sin(angles)
+    points = np.empty(np.shape(angles) + (2,))
+    points[..., 0] = centres[..., 0] + cos * v[..., 0] - sin * v[..., 1]
+    points[..., 1] = centres[..., 1] + sin * v[..., 0] + cos * v[..., 1]
+    return points
 
-    for seg, length in zip(polygon, lengths):
+def get_critical_points(segments, n_pieces=16):
+    """
+    Points on each segment at which its distance to the other polygon may be greatest, with the polygon of each point.
+
+    The distance to a polygon is the least of the distances to its corners, to the lines of its straight segments
+    and to its circle, each of the latter two only counting where the nearest point on it lies within a segment.
+    Along a line or arc this is greatest at an end, where two of these distances are equal, where one stops counting,
+    or where one of them peaks. Each of these is found as the roots of a polynomial in t, from points on lines at
+    s + t v and on arcs at tan(angle / 2) = t around their midpoints.
+
+    Only features which could be nearest where the distance could be greatest are considered. Each segment is cut
+    into pieces, over which the distances at their ends bound the distances to each segment of the other polygon.
+    Pieces which cannot reach the greatest of the distances at the ends are dropped, and on the rest only the
+    features of segments which could be nearest are kept, with ties only between those which could be nearest on
+    the same piece.
+    """
+    starts, ends, centres, radii, angles, is_line, owners = segments
+    n_segments = len(starts)
+
+    # Work in coordinates of order one, to keep the polynomials well conditioned
+    origin = starts.mean(axis=0)
+    scale = max(np.abs(np.concatenate([starts, centres[~is_line]]) - origin).max() + radii.max(initial=0), 1)
+    starts, ends, centres, radii = (starts - origin) / scale, (ends - origin) / scale, (centres - origin) / scale, radii / scale
+    lengths = np.where(is_line, np.hypot(ends[:, 0] - starts[:, 0], ends[:, 1] - starts[:, 1]), angles * radii)
+
+    # Bounds on the distances to each segment over each piece, from those at its ends
+    t = np.linspace(0, 1, n_pieces + 1)
+    line_points = starts[:, None] + t[:, None] * (ends - starts)[:, None]
+    arc_points = get_arc_points(centres[:, None], starts[:, None], t * angles[:, None])
+    piece_ends = np.where(is_line[:, None, None], line_points, arc_points)
+    closest = get_closest_points((starts, ends, centres, radii, angles, is_line), piece_ends[:, :, None])
+    dists = np.hypot(piece_ends[:, :, None, 0] - closest[..., 0], piece_ends[:, :, None, 1] - closest[..., 1])
+    dists = np.where((owners[:, None] != owners)[:, None] & ~np.isnan(dists), dists, np.inf)
+
+    half_lengths = (lengths / n_pieces / 2)[:, None, None]
+    middles = (dists[:, :-1] + dists[:, 1:]) / 2
+    bounds = (middles + half_lengths).min(axis=2)
+    alive = bounds >= dists.min(axis=2).max() - 1e-9
+    near = alive[..., None] & (middles - half_lengths <= bounds[..., None])
+
+    # The features of each segment are the corner at its start, also the end of the previous segment of its polygon,
+    # and its line, or its polygon's circle, given by the polygon's first arc
+    first = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+    previous = np.arange(n_segments) - 1
+    previous[first] = np.r_[first[1:], n_segments] - 1
+    lines = is_line & (lengths > 0)
+    arcs = np.flatnonzero(~is_line)
+    near_corners = near | near[..., previous]
+    near_lines = near & lines
+    circles = np.zeros((n_segments, n_segments), np.int32)
+    circles[arcs, arcs[np.searchsorted(owners[arcs], owners[arcs])]] = 1
+    near_circles = near.astype(np.int32) @ circles > 0
+
+    # Arcs are taken around their midpoints, with t = +-tan(angle / 4) at their ends
+    arc_middles = get_arc_points(centres, starts, angles / 2) - centres
+    px = np.where(is_line[:, None], np.stack([starts[:, 0], ends[:, 0] - starts[:, 0], 0 * radii], 1),
+        np.stack([centres[:, 0] + arc_middles[:, 0], -2 * arc_middles[:, 1], centres[:, 0] - arc_middles[:, 0]], 1))
+    py = np.where(is_line[:, None], np.stack([starts[:, 1], ends[:, 1] - starts[:, 1], 0 * radii], 1),
+        np.stack([centres[:, 1] + arc_middles[:, 1], 2 * arc_middles[:, 0], centres[:, 1] - arc_middles[:, 1]], 1))
+    pw = np.where(is_line[:, None], [1.0, 0.0, 0.0], [1.0, 0.0, 1.0])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        directions = np.where(lines[:, None], (ends - starts) / lengths[:, None], 0)
+    normals = perpendicular(directions)
+
+    # Squared distances from each segment to each corner and line, as polynomials in t times w^2
+    x, y, w = px[:, None], py[:, None], pw[:, None]
+    feature_dists = np.concatenate([
+        poly_mul(x - starts[:, 0, None] * w, x - starts[:, 0, None] * w) + poly_mul(y - starts[:, 1, None] * w, y - starts[:, 1, None] * w),
+        poly_mul(*[normals[:, 0, None] * x + normals[:, 1, None] * y - np.sum(normals * starts, 1)[:, None] * w] * 2),
+    ], 1)
+    near_features = np.concatenate([near_corners, near_lines], 2).astype(np.int32)
+
+    # Ties between corners and lines which could be nearest on the same piece
+    segment, f, g = np.nonzero(np.triu(np.einsum('sjf,sjg->sfg', near_features, near_features) > 0, 1))
+    polynomials = [feature_dists[segment, f] - feature_dists[segment, g]]
+    polynomial_segments = [segment]
+
+    # Distances to a circle, |d - r|, equal to a distance e where (d^2 - r^2 - e^2)^2 = 4 r^2 e^2
+    segment, k, g = np.nonzero(np.einsum('sjk,sjg->skg', near_circles.astype(np.int32), near_features) > 0)
+    xs, ys, ws = px[segment], py[segment], pw[segment]
+    cx, cy, r = centres[k, 0, None], centres[k, 1, None], radii[k, None]
+    ww = poly_mul(ws, ws)
+    difference = poly_mul(xs - cx * ws, xs - cx * ws) + poly_mul(ys - cy * ws, ys - cy * ws) - r**2 * ww - feature_dists[segment, g]
+    polynomials.append(poly_mul(difference, difference) - 4 * r**2 * poly_mul(ww, feature_dists[segment, g]))
+    polynomial_segments.append(segment)
+
+    # Lines a.p = b across the ends of nearby lines, and through the centres and ends of nearby arcs, where distances
+    # stop counting, and on arcs through their centres, towards nearby corners and circles or along nearby lines,
+    # or on lines across them through nearby circles' centres, where distances peak
+    near_lines, near_circles, near_corners = near_lines.any(axis=1), near_circles.any(axis=1), near_corners.any(axis=1)
+    on_arcs = ~is_line[:, None]
+    form_segments, form_a, form_b = [], [], []
+    segment, k = np.nonzero(near_lines)
+    for point in (starts, ends):
+        form_segments.append(segment); form_a.append(directions[k]); form_b.append(np.sum(directions[k] * point[k], 1))
+    segment, k = np.nonzero(near.any(axis=1) & ~is_line)
+    for point in (starts, ends):
+        a = perpendicular(point[k] - centres[k])
+        form_segments.append(segment); form_a.append(a); form_b.append(np.sum(a * centres[k], 1))
+    segment, k = np.nonzero(near_corners & on_arcs)
+    a = perpendicular(starts[k] - centres[segment])
+    form_segments.append(segment); form_a.append(a); form_b.append(np.sum(a * centres[segment], 1))
+    segment, k = np.nonzero(near_circles & on_arcs)
+    a = perpendicular(centres[k] - centres[segment])
+    form_segments.append(segment); form_a.append(a); form_b.append(np.sum(a * centres[segment], 1))
+    segment, k = np.nonzero(near_lines & on_arcs)
+    a = directions[k]
+    form_segments.append(segment); form_a.append(a); form_b.append(np.sum(a * centres[segment], 1))
+    segment, k = np.nonzero(near_circles & ~on_arcs)
+    a = ends[segment] - starts[segment]
+    form_segments.append(segment); form_a.append(a); form_b.append(np.sum(a * centres[k], 1))
+
+    segment, a, b = np.concatenate(form_segments), np.concatenate(form_a), np.concatenate(form_b)
+    polynomials.append(a[:, 0, None] * px[segment] + a[:, 1, None] * py[segment] - b[:, None] * pw[segment])
+    polynomial_segments.append(segment)
+
+    # Keep the roots lying on the segments, allowing for rounding at their ends
+    segment = np.concatenate(polynomial_segments)
+    rows = np.cumsum([0] + [len(polynomial) for polynomial in polynomials])
+    padded = np.zeros((len(segment), 9))
+    for row, polynomial in zip(rows, polynomials):
+        padded[row:row + len(polynomial), :polynomial.shape[-1]] = polynomial
+    polynomials = padded
+    t = get_real_roots(polynomials)
+    upper = np.where(is_line, 1, np.tan(angles / 4))[segment, None]
+    lower = np.where(is_line[segment, None], 0, -upper)
+    keep = (t >= lower - 1e-9) & (t <= upper + 1e-9)
+    t = np.clip(t, lower, upper)[keep]
+    segment = segment[np.nonzero(keep)[0]]
+
+    line_points = starts[segment] + t[:, None] * (ends - starts)[segment]
+    arc_points = get_arc_points(centres[segment], (centres + arc_middles)[segment], 2 * np.arctan(t))
+    points = np.concatenate([piece_ends.reshape(-1, 2), np.where(is_line[segment, None], line_points, arc_points)])
+    return points * scale + origin, np.concatenate([np.repeat(owners, n_pieces + 1), owners[segment]])
+
+def perpendicular(vectors):
+    return np.stack([-vectors[:, 1], vectors[:, 0]], 1)
+
+def get_bounded_distance(segments, tolerance, max_pieces=1 << 16, max_rounds=32):
+    """
+    Greatest distance from a point on either polygon to the other, to within a tolerance, by branch and bound over
+    pieces of their segments.
+
+    The distance to a polygon changes no faster than the point moves, so no point on a piece of length L whose ends
+    are at distances f0 and f1 is further than (f0 + f1 + L) / 2. Nor is any point further than the furthest point
+    of the piece from the nearest points to its ends, which is the tighter bound once pieces are short. A piece of
+    line whose ends are nearest the same line of the other polygon is no further than its ends, and a piece whose
+    ends are nearest the same arc is no further than the furthest of its points from that arc's circle. Pieces which
+    could not be further than the best distance found, plus the tolerance, are dropped, and the rest are cut until
+    none remain, or until there would be more than max_pieces of them or max_rounds of cutting have been done, when
+    the bound reached is returned.
 
-        # No need to discretise lines, final point pair 
-        # will never be in the middle of the line
-        if isinstance(seg, Line):
-            points.append(seg.b)
-            continue
+    Returns:
+        tuple: the greatest distance found, its point and the nearest point of the other polygon to it, and a bound
+            on how much greater the true distance may be, which is only more than the tolerance if cut short.
+    """
+    starts, ends, centres, radii, angles, is_line, owners = segments
+    lengths = np.where(is_line, np.hypot(ends[:, 0] - starts[:, 0], ends[:, 1] - starts[:, 1]), angles * radii)
+
+    # Starting from pieces of about a sixty-fourth of the edges saves the first rounds of cutting
+    counts = np.maximum(np.ceil(64 * lengths / max(lengths.sum(), 1e-12)), 1).astype(np.int64)
+    pieces = np.repeat(np.arange(len(starts)), counts)
+    t0 = (np.arange(len(pieces)) - (np.cumsum(counts) - counts)[pieces]) / counts[pieces]
+    t1 = t0 + 1 / counts[pieces]
+    p0, f0, q0, k0 = get_segment_distances(segments, pieces, t0)
+    p1, f1, q1, k1 = get_segment_distances(segments, pieces, t1)
+
+    best = np.argmax(f0)
+    distance, point, other = f0[best], p0[best], q0[best]
+    bound = distance
+    rounds = 0
+
+    while len(pieces) > 0:
+        upper = np.minimum.reduce([
+            (f0 + f1 + (t1 - t0) * lengths[pieces]) / 2,
+            get_furthest_dists(segments, pieces, t0, t1, p0, p1, q0),
+            get_furthest_dists(segments, pieces, t0, t1, p0, p1, q1),
+            np.where(is_line[pieces] & (k0 == k1) & is_line[k0], np.maximum(f0, f1), np.inf),
+            get_circle_dists(segments, pieces, t0, t1, p0, p1, k0, k1),
+        ])
+        refine = upper > distance + tolerance
+        rounds += 1
+        if rounds > max_rounds or 4 * refine.sum() > max_pieces:
+            bound = max(bound, upper.max(initial=0))
+            break
+        bound = max(bound, upper[~refine].max(initial=0))
+        pieces, t0, t1, p0, p1, f0, f1, q0, q1, k0, k1 = (
+            array[refine] for array in (pieces, t0, t1, p0, p1, f0, f1, q0, q1, k0, k1)
+        )
+        if len(pieces) == 0:
+            break
+
+        # Pieces are cut in four, taking half as many rounds as halving them for little more work in each
+        cuts = (t0 + (t1 - t0) * np.arange(1, 4)[:, None] / 4).ravel()
+        pm, fm, qm, km = get_segment_distances(segments, np.tile(pieces, 3), cuts)
+        best = np.argmax(fm)
+        if fm[best] > distance:
+            distance, point, other = fm[best], pm[best], qm[best]
+
+        pieces = np.tile(pieces, 4)
+        t0, t1 = np.concatenate([t0, cuts]), np.concatenate([cuts, t1])
+        p0, p1 = np.concatenate([p0, pm]), np.concatenate([pm, p1])
+        f0, f1 = np.concatenate([f0, fm]), np.concatenate([fm, f1])
+        q0, q1 = np.concatenate([q0, qm]), np.concatenate([qm, q1])
+        k0, k1 = np.concatenate([k0, km]), np.concatenate([km, k1])
+
+    return float(distance), point, other, max(float(bound) - float(distance), 0.0)
+
+def get_furthest_dists(segments, pieces, t0, t1, p0, p1, q):
+    """
+    Greatest distances from points q to the pieces of segments from t0, at p0, to t1, at p1. This is at an end of the
+    piece, unless it is a piece of arc holding the point opposite q about its centre.
+    """
+    starts, ends, centres, radii, angles, is_line, owners = segments
+    ends_dists = np.maximum(np.hypot(*(p0 - q).T), np.hypot(*(p1 - q).T))
 
-        seg_number = length // step
-        for i in range(int(seg_number), 0, -1):
-            point = seg.get_point(i / seg_number)
-            points.append(point)
+    v = centres[pieces] - q
+    u = starts[pieces] - centres[pieces]
+    opposite = np.arctan2(u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0], u[:, 0] * v[:, 0] + u[:, 1] * v[:, 1])
+    opposite = np.where(opposite < 0, opposite + 2 * np.pi, opposite)
+    holds_opposite = ~is_line[pieces] & (opposite >= t0 * angles[pieces]) & (opposite <= t1 * angles[pieces])
+    return np.where(holds_opposite, radii[pieces] + np.hypot(v[:, 0], v[:, 1]), ends_dists)
 
-    return points
+def get_circle_dists(segments, pieces, t0, t1, p0, p1, k0, k1):
+    """
+    Greatest distances from the pieces of segments from t0, at p0, to t1, at p1, to the circles of the arcs k0
+    nearest their ends, for pieces whose ends are nearest the same arc, and infinite for the rest.
+
+    The distance to the circle, |d - r| for a point at d from its centre, is greatest where d is, at an end of the
+    piece or at the point of an arc in line with the centres, and bounds the distance to the polygon while the
+    directions to the piece from the centre stay within the arc. They turn by no more than the length of the piece
+    over its least distance from the centre, which is checked against how far the ends' directions are within it.
+    """
+    starts, ends, centres, radii, angles, is_line, owners = segments
+    lengths = np.where(is_line, np.hypot(ends[:, 0] - starts[:, 0], ends[:, 1] - starts[:, 1]), angles * radii)
+    c, r = centres[k0], radii[k0]
+    d0, d1 = np.hypot(*(p0 - c).T), np.hypot(*(p1 - c).T)
+
+    # Arcs are nearest and furthest from the centre in line with their own centre, lines at the foot from it
+    u = starts[pieces] - centres[pieces]
+    v = centres[pieces] - c
+    turns = np.arctan2(u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0], u[:, 0] * v[:, 0] + u[:, 1] * v[:, 1])
+    turns = np.stack([turns, turns + np.pi]) % (2 * np.pi)
+    holds = ~is_line[pieces] & (turns >= t0 * angles[pieces]) & (turns <= t1 * angles[pieces])
+    span = np.hypot(v[:, 0], v[:, 1])
+    furthest = np.where(holds[0], radii[pieces] + span, np.maximum(d0, d1))
+    nearest = np.where(holds[1], np.abs(radii[pieces] - span), np.minimum(d0, d1))
+    w = p1 - p0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        foot = np.clip(np.sum((c - p0) * w, 1) / np.sum(w * w, 1), 0, 1)
+        nearest = np.where(is_line[pieces], np.hypot(*(p0 + np.nan_to_num(foot)[:, None] * w - c).T), nearest)
+
+        # How far the directions to the ends lie within the arc, negative outside it
+        a = starts[k0] - c
+        margins = []
+        for p in (p0, p1):
+            b = p - c
+            within = np.arctan2(a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0], a[:, 0] * b[:, 0] + a[:, 1] * b[:, 1])
+            within = within % (2 * np.pi)
+            margins.append(np.minimum(within, angles[k0] - within))
+        turning = (t1 - t0) * lengths[pieces] / nearest
+
+    applies = (k0 == k1) & ~is_line[k0] & ((angles[k0] >= 2 * np.pi) | (turning < margins[0] + margins[1]))
+    return np.where(applies, np.maximum(furthest - r, r - nearest), np.inf)
+
+def get_segment_distances(segments, pieces, t):
+    """
+    Points at t along the given segments, their distances to the other polygon, and its nearest points and segments.
+    """
+    starts, ends, centres, radii, angles, is_line, owners = segments
+    line_points = starts[pieces] + t[:, None] * (ends - starts)[pieces]
+    arc_points = get_arc_points(centres[pieces], starts[pieces], t * angles[pieces])
+    points = np.where(is_line[pieces, None], line_points, arc_points)
+    dists, closest, nearest = get_smallest_dists(segments, points, owners[pieces, None] != owners)
+    return points, np.where(np.isnan(dists), 0, dists), closest, nearest
+
+def poly_mul(a, b):
+    """
+    Products of polynomials given by their coefficients, from the lowest power, along the last axis.
+    """
+    product = np.zeros(np.broadcast_shapes(a.shape[:-1], b.shape[:-1]) + (a.shape[-1] + b.shape[-1] - 1,))
+    for i in range(a.shape[-1]):
+        product[..., i:i + b.shape[-1]] += a[..., i, None] * b
+    return product
 
-def get_smallest_dist(polygon, point):
-    smallest_dist = 1e9
-    other_point = None
-    for seg in polygon:
-        closest = seg.get_closest_point(point)
-        dist = np.linalg.norm(point - closest)
-        if dist < smallest_dist:
-            smallest_dist = dist
-            other_point = closest
-    return smallest_dist, other_point
+def get_real_roots(polynomials, tolerance=1e-7):
+    """
+    Real roots of polynomials given by their coefficients, from the lowest power, along the last axis, as an (N, K)
+    array padded with NaN.
+
+    Roots within the unit circle are found from the polynomials, and those outside it from the reversed polynomials,
+    so that a vanishing leading coefficient only loses roots which the other finds. Polynomials which are zero
+    throughout have no roots.
+    """
+    n = polynomials.shape[-1]
+    sizes = np.abs(polynomials).max(axis=1)
+    polynomials = polynomials / np.where(sizes > 1e-12, sizes, np.inf)[:, None]
+
+    # Roots at zero are factored out, leaving a polynomial of the same degree either way round
+    nonzero = np.abs(polynomials) > 1e-12
+    lows = np.argmax(nonzero, axis=1)
+    highs = n - 1 - np.argmax(nonzero[:, ::-1], axis=1)
+    roots = [np.where(lows[:, None] > 0, 0.0, np.nan)]
+    degrees = np.where(nonzero.any(axis=1), highs - lows, 0)
+
+    # Linear and quadratic polynomials, the most common, are solved directly, taking the root of larger size from
+    # the quadratic formula and the other from the product of the roots
+    c, b, a = np.take_along_axis(polynomials, np.minimum(lows[:, None] + np.arange(3), n - 1), 1).T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        discriminants = b * b - 4 * a * c
+        real = (degrees == 2) & (discriminants >= -(2 * tolerance * a) ** 2)
+        q = -(b + np.copysign(np.sqrt(np.maximum(discriminants, 0)), b)) / 2
+        roots.append(np.where(real[:, None], np.stack([q / a, c / q], 1), np.nan))
+        roots.append(np.where(degrees[:, None] == 1, -c[:, None] / b[:, None], np.nan))
+
+    for degree in range(3, n):
+        rows = np.flatnonzero(degrees == degree)
+        if len(rows) == 0:
+            continue
+        coefficients = np.take_along_axis(polynomials[rows], lows[rows, None] + np.arange(degree + 1), 1)
+        coefficients = np.concatenate([coefficients, coefficients[:, ::-1]])
+        companion = np.zeros((len(coefficients), degree, degree))
+        companion[:, 0] = -coefficients[:, degree - 1::-1] / coefficients[:, degree, None]
+        companion[:, np.arange(1, degree), np.arange(degree - 1)] = 1
+        values = np.linalg.eigvals(companion)
+        real = (np.abs(values.imag) <= tolerance) & (np.abs(values) <= 1 + tolerance)
+        values = np.where(real, values.real, np.nan)
+        with np.errstate(divide='ignore'):
+            values[len(rows):] = 1 / values[len(rows):]
+        found = np.full((len(polynomials), 2 * degree), np.nan)
+        found[rows] = np.concatenate([values[:len(rows)], values[len(rows):]], 1)
+        roots.append(found)
+
+    return np.concatenate(roots, 1)
+
+def get_closest_points(segments, points):
+    """
+    Closest points on segments to points, as an array of shape (..., 2), for segment arrays and points broadcasting
+    to the shape (...).
+    """
+    starts, ends, centres, radii, angles, is_line = segments[:6]
+    px, py = points[..., 0], points[..., 1]
+    sx, sy = starts[..., 0], starts[..., 1]
+    ex, ey = ends[..., 0], ends[..., 1]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vx, vy = ex - sx, ey - sy
+        l = np.sqrt(vx * vx + vy * vy)
+        ux, uy = vx / l, vy / l
+        d = np.minimum(np.maximum((px - sx) * ux + (py - sy) * uy, 0), l)
+
+        # Points whose direction from the centre lies beyond an arc's end are clamped to its end, which, going round
+        # from the start, is whether the direction lies outside the turn from the start to the end
+        cx, cy = centres[..., 0], centres[..., 1]
+        wx, wy = px - cx, py - cy
+        after_start = (sx - cx) * wy - (sy - cy) * wx >= 0
+        before_end = wx * (ey - cy) - wy * (ex - cx) >= 0
+        beyond = np.where(angles > np.pi, ~after_start & ~before_end, ~after_start | ~before_end)
+        scale = radii / np.sqrt(wx * wx + wy * wy)
+
+        closest = np.empty(np.broadcast_shapes(px.shape, sx.shape) + (2,))
+        closest[..., 0] = np.where(is_line, sx + d * ux, np.where(beyond, ex, cx + wx * scale))
+        closest[..., 1] = np.where(is_line, sy + d * uy, np.where(beyond, ey, cy + wy * scale))
+    return closest
+
+def get_smallest_dists(segments, points, valid=True):
+    """
+    Distances from each of an (..., M, 2) array of points to the nearest of (..., S) segments, as an (..., M) array,
+    with the (..., M, 2) closest points and the (..., M) indices of their segments. Segments may be excluded for some
+    points with an (..., M, S) mask.
+    """
+    # Laid out as (..., S, M), so that the long axis of points is innermost
+    starts, ends, centres = (np.expand_dims(array, -2) for array in segments[:3])
+    radii, angles, is_line = (np.expand_dims(array, -1) for array in segments[3:6])
+    closest = get_closest_points((starts, ends, centres, radii, angles, is_line), points[..., None, :, :])
+    dists = (points[..., None, :, 0] - closest[..., 0])**2 + (points[..., None, :, 1] - closest[..., 1])**2
+
+    # Degenerate segments give no distance, and the first of equally near segments is taken
+    valid = np.swapaxes(np.asarray(valid), -1, -2) if np.ndim(valid) >= 2 else valid
+    nearest = np.argmin(np.where(valid & ~np.isnan(dists), dists, np.inf), axis=-2)
+    closest = np.take_along_axis(closest, nearest[..., None, :, None], -3)[..., 0, :, :]
+    return np.hypot(*np.moveaxis(points - closest, -1, 0)), closest, nearest
+
+def make_polygons(frame_sizes, circles, has_circle):
+    """
+    Vectorised version of `make_polygon`, giving the segments of P polygons as segment arrays of shape (P, S).
+
+    The candidate start points of the segments are visited in the same order as `make_polygon`, around the frame
+    from its top edge, and the valid ones gathered to the front of each row.
+
+    Returns:
+        tuple: segment arrays as from `get_segment_arrays`, without owners, and a (P, S) mask of the valid segments.
+    """
+    h, w = frame_sizes[:, 0].astype(np.float64), frame_sizes[:, 1].astype(np.float64)
+    x, y, r = np.where(has_circle[:, None], circles, 0).T
+    zeros = np.zeros(len(x))
+
+    with np.errstate(invalid='ignore'):
+        d_top = np.sqrt(r**2 - y**2)
+        d_right = np.sqrt(r**2 - (x - w)**2)
+        d_bottom = np.sqrt(r**2 - (y - h)**2)
+        d_left = np.sqrt(r**2 - x**2)
+    top, right = has_circle & (y - r < 0), has_circle & (x + r > w)
+    bottom, left = has_circle & (y + r > h), has_circle & (x - r < 0)
+
+    # Candidates as (condition, x, y, is_line), where a condition of None marks a corner, which starts a line if
+    # the previous segment was also a line
+    candidates = [
+        (~has_circle, zeros, zeros, True),
+        (top & (x - d_top > 0), x - d_top, zeros, True),
+        (top & (x + d_top < w), x + d_top, zeros, False),
+        (None, w, zeros, True),
+        (right & (y - d_right > 0), w, y - d_right, True),
+        (right & (y + d_right < h), w, y + d_right, False),
+        (None, w, h, True),
+        (bottom & (x + d_bottom < w), x + d_bottom, h, True),
+        (bottom & (x - d_bottom > 0), x - d_bottom, h, False),
+        (None, zeros, h, True),
+        (left & (y + d_left < h), zeros, y + d_left, True),
+        (left & (y - d_left > 0), zeros, y - d_left, False),
+        (None, zeros, zeros, has_circle),
+    ]
+
+    valid = np.zeros((len(x), len(candidates)), dtype=bool)
+    points = np.zeros((len(x), len(candidates), 2))
+    is_line = np.zeros((len(x), len(candidates)), dtype=bool)
+    any_valid = np.zeros(len(x), dtype=bool)
+    last_line = np.zeros(len(x), dtype=bool)
+    for i, (condition, px, py, line) in enumerate(candidates):
+        if condition is None:
+            condition = any_valid & last_line & line
+            if i == 3:
+                condition |= top & ~any_valid
+        valid[:, i], points[:, i, 0], points[:, i, 1], is_line[:, i] = condition, px, py, line
+        any_valid |= condition
+        last_line = np.where(condition, line, last_line)
+
+    # Gather the valid candidates to the front, each segment ending at the start of the next
+    order = np.argsort(~valid, axis=1, kind='stable')
+    counts = valid.sum(axis=1)
+    n_segments = max(int(counts.max(initial=0)), 1)
+    order = order[:, :n_segments]
+    rows = np.arange(len(x))[:, None]
+    columns = np.arange(n_segments)
+    starts = points[rows, order]
+    ends = starts[rows, (columns + 1) % np.maximum(counts, 1)[:, None]]
+    is_line = is_line[rows, order]
+    segment_valid = columns < counts[:, None]
+
+    # Circles lying within the frame have a single segment
+    full_circle = has_circle & (counts == 0)
+    segment_valid[full_circle, 0] = True
+    is_line[full_circle, 0] = False
+    starts[full_circle, 0] = np.stack([x + r, y], axis=1)[full_circle]
+    ends[full_circle, 0] = starts[full_circle, 0]
+
+    centres = np.broadcast_to(np.stack([x, y], axis=1)[:, None], starts.shape)
+    centres = np.where(is_line[..., None], 0, centres)
+    radii = np.where(is_line, 0, r[:, None])
+    angles = np.arctan2(ends[..., 1] - centres[..., 1], ends[..., 0] - centres[..., 0])
+    angles -= np.arctan2(starts[..., 1] - centres[..., 1], starts[..., 0] - centres[..., 0])
+    angles = np.where(angles < 0, angles + 2 * np.pi, angles)
+    angles[full_circle, 0] = 2 * np.pi
+    angles = np.where(is_line, 0, angles)
+
+    return starts, ends, centres, radii, angles, is_line, segment_valid
 
 def content_area_hausdorff(
     circle_a: Optional[Sequence[int]],
     circle_b: Optional[Sequence[int]],
     frame_size: Sequence[int],
     n_points: int = 100,
-    normalise: bool = True
-) -> Tuple[float, Optional[Sequence[Sequence[int]]]]:
+    normalise: bool = True,
+    exact: bool = False,
+    tolerance: Optional[float] = None
+) -> Union[Tuple[float, Optional[Sequence[Sequence[int]]]], Tuple[float, Optional[Sequence[Sequence[int]]], float]]:
     """
     Hausdorff distance between two content areas.
 
@@ -194,36 +659,158 @@ def content_area_hausdorff(
         frame_size: size of the image in question.
         n_points: number of points used when discretising the edges of the content areas.
         normalise: whether or not to normalise the result as if the image were 1080x1920.
+        exact: whether to measure from the points at which the distance may be greatest, found analytically, rather
+            than from n_points along the edges, giving the exact distance. These are the ends of pieces of the edges
+            and the roots of up to a few hundred polynomials, typically a few dozen, costing about 2 ms per call,
+            around four times the default and about as much as a few thousand n_points.
+        tolerance: if given, the error allowed, in the same units as the score, in place of n_points. The edges are
+            refined until the score is certified to be within the tolerance, and the bound on its error is also
+            returned, which is zero if exact. Nearly equal content areas take longest, about 4 ms at 1e-3 px and
+            7 ms at 1e-9 px for concentric circles a pixel apart, and otherwise calls take 1 to 2 ms.
     Returns:
         float: score in pixels (optionally normalised)
         tuple: the coordinates of the two points found to give the final score.
+        float: if tolerance is given, a bound on how much the score may fall short, in the same units as the score.
     """
+    if tolerance != None and not tolerance > 0:
+        raise ValueError("Invalid tolerance {}! The tolerance must be positive.".format(tolerance))
 
     if (circle_a == circle_b):
-        return 0.0, None
+        return (0.0, None) if tolerance == None else (0.0, None, 0.0)
 
     polygon_a = make_polygon(frame_size, circle_a)
     polygon_b = make_polygon(frame_size, circle_b)
 
-    points_a = get_polygon_points(polygon_a, n_points)
-    points_b = get_polygon_points(polygon_b, n_points)
+    segments = get_segment_arrays([polygon_b, polygon_a])
+    scaling = np.linalg.norm([1080, 1920]) / np.linalg.norm(frame_size) if normalise else 1.0
+
+    if tolerance != None and not exact:
+        hausdorff_distance, point, other, error = get_bounded_distance(segments, tolerance / scaling)
+        best_pair = (point, other) if hausdorff_distance > 0 else None
+        return hausdorff_distance * scaling, best_pair, error * scaling
+
+    if exact:
+        points, point_owners = get_critical_points(segments)
+    else:
+        points, point_owners = get_polygon_points(segments, n_points)
+
+    # Both directions are measured at once, with each point only against the segments of the other polygon
+    dists, others, _ = get_smallest_dists(segments, points, point_owners[:, None] != segments[-1])
 
     hausdorff_distance = 0.0
     best_pair = None
 
-    for point in points_b:
-        dist, other_point = get_smallest_dist(polygon_a, point)
-        if dist > hausdorff_distance:
-            hausdorff_distance = dist
-            best_pair = (point, other_point)
+    # The first of equally distant points is taken
+    best = np.argmax(np.where(np.isnan(dists), 0, dists))
+    if dists[best] > 0:
+        hausdorff_distance = float(dists[best])
+        best_pair = (points[best], others[best])
 
-    for point in points_a:
-        dist, other_point = get_smallest_dist(polygon_b, point)
-        if dist > hausdorff_distance:
-            hausdorff_distance = dist
-            best_pair = (point, other_point)
-
-    if normalise:
-        hausdorff_distance = hausdorff_distance * np.linalg.norm([1080, 1920]) / np.linalg.norm(frame_size)
+    hausdorff_distance = hausdorff_distance * scaling
 
+    if tolerance != None:
+        return hausdorff_distance, best_pair, 0.0
     return hausdorff_distance, best_pair
+
+def content_area_hausdorff_batch(
+    circles_a,
+    circles_b,
+    frame_sizes,
+    n_points: int = 100,
+    normalise: bool = True,
+    return_pairs: bool = False,
+    chunk_size: int = 64
+):
+    """
+    Hausdorff distances between many pairs of content areas, as from `content_area_hausdorff`.
+
+    Missing content areas, in place of None, are given by rows containing NaN, masked rows of a masked array, or
+    None entries of a list. Pairs are scored in chunks, each as a single set of array operations.
+
+    Args:
+        circles_a: (N, 3) circles for the first content areas.
+        circles_b: (N, 3) circles for the second content areas.
+        frame_sizes: (N, 2) sizes of the images in question, or a single size for all of them.
+        n_points: number of points used when discretising the edges of the content areas.
+        normalise: whether or not to normalise the results as if the images were 1080x1920.
+        return_pairs: whether or not to also return the points found to give each score.
+        chunk_size: number of pairs scored at once, bounding the memory used.
+    Returns:
+        np.ndarray: (N,) scores in pixels (optionally normalised).
+        np.ndarray: if return_pairs, the (N, 2, 2) coordinates of the two points found to give each score, NaN
+            where the score is 0.
+    """
+    circles_a, has_a = as_circle_array(circles_a)
+    circles_b, has_b = as_circle_array(circles_b)
+    frame_sizes = np.broadcast_to(np.asarray(frame_sizes, dtype=np.float64), (len(circles_a), 2))
+
+    scores = np.zeros(len(circles_a))
+    pairs = np.full((len(circles_a), 2, 2), np.nan)
+
+    # Identical content areas, including both missing, need no scoring
+    same = (has_a == has_b) & (~has_a | np.all(circles_a == circles_b, axis=1))
+    rows = np.flatnonzero(~same)
+
+    for chunk in np.array_split(rows, max(-(-len(rows) // chunk_size), 1)):
+        if len(chunk) == 0:
+            continue
+        # Polygons are interleaved as b then a for each pair, matching the order of `content_area_hausdorff`
+        polygon_circles = np.stack([circles_b[chunk], circles_a[chunk]], axis=1).reshape(-1, 3)
+        polygon_has_circle = np.stack([has_b[chunk], has_a[chunk]], axis=1).reshape(-1)
+        polygon_frame_sizes = np.repeat(frame_sizes[chunk], 2, axis=0)
+        chunk_scores, chunk_pairs = score_polygon_pairs(polygon_frame_sizes, polygon_circles, polygon_has_circle, n_points)
+        scores[chunk] = chunk_scores
+        pairs[chunk] = chunk_pairs
+
+    if normalise:
+        scores = scores * np.linalg.norm([1080, 1920]) / np.hypot(frame_sizes[:, 0], frame_sizes[:, 1])
+
+    if return_pairs:
+        return scores, pairs
+    return scores
+
+def as_circle_array(circles):
+    if isinstance(circles, np.ma.MaskedArray):
+        circles = circles.astype(np.float64).filled(np.nan)
+    elif not isinstance(circles, np.ndarray):
+        circles = [(np.nan,) * 3 if circle is None else circle for circle in circles]
+    circles = np.asarray(circles, dtype=np.float64).reshape(-1, 3)
+    has_circle = ~np.isnan(circles).any(axis=1)
+    return np.where(has_circle[:, None], circles, 0), has_circle
+
+def score_polygon_pairs(frame_sizes, circles, has_circle, n_points):
+    # Polygons come in pairs, whose points are each measured against the segments of the other polygon of the pair
+    *segments, segment_valid = make_polygons(frame_sizes, circles, has_circle)
+    n_pairs, n_segments = len(circles) // 2, segment_valid.shape[1]
+
+    owners = np.repeat(np.arange(len(circles)), n_segments).reshape(segment_valid.shape)
+    flat_segments = [array[segment_valid] for array in segments] + [owners[segment_valid]]
+    flat_points, point_owners = get_polygon_points(flat_segments, n_points)
+
+    # Pad the points of each polygon into rows
+    point_counts = np.bincount(point_owners, minlength=len(circles))
+    n_polygon_points = int(point_counts.max())
+    ranks = np.arange(len(point_owners)) - (np.cumsum(point_counts) - point_counts)[point_owners]
+    points = np.zeros((len(circles), n_polygon_points, 2))
+    point_valid = np.zeros((len(circles), n_polygon_points), dtype=bool)
+    points[point_owners, ranks] = flat_points
+    point_valid[point_owners, ranks] = True
+
+    # The points of each polygon are measured against the segments of the other polygon of its pair
+    others = np.arange(len(circles)) ^ 1
+    other_segments = [array[others] for array in segments]
+    dists, closest, _ = get_smallest_dists(other_segments, points, segment_valid[others, None, :])
+
+    points = points.reshape(n_pairs, 2 * n_polygon_points, 2)
+    point_valid = point_valid.reshape(n_pairs, 2 * n_polygon_points)
+    dists = dists.reshape(n_pairs, 2 * n_polygon_points)
+    others = closest.reshape(n_pairs, 2 * n_polygon_points, 2)
+
+    # The first of equally distant points is taken
+    dists = np.where(point_valid & ~np.isnan(dists), dists, 0)
+    best = np.argmax(dists, axis=1)
+    rows = np.arange(n_pairs)
+    scores = dists[rows, best]
+    pairs = np.stack([points[rows, best], others[rows, best]], axis=1)
+    pairs[scores <= 0] = np.nan
+    return scores, pairs
@@ -0,0 +1,370 @@
+import numpy as np
+import tarfile
+import zipfile
+from os import path, stat, replace, getpid, pread, close, register_at_fork
+from os import open as open_fd, O_RDONLY
+from io import BytesIO
+from zlib import decompress
+from posixpath import dirname
+from json import loads, dumps
+from threading import Lock
+from PIL import Image
+
+class FileStore():
+    """
+    Loads images from the individual files of the dataset.
+
+    Args:
+        data_directory: root directory of the ECA data.
+    """
+    def __init__(self, data_directory: str) -> None:
+        self.data_directory = data_directory
+
+    def read(self, file):
+        with open(path.join(self.data_directory, file), "rb") as data:
+            return data.read()
+
+    def stat(self, file):
+        file_stat = stat(path.join(self.data_directory, file))
+        return file_stat.st_mtime_ns, file_stat.st_size
+
+    def sidecar(self, file):
+        return path.join(self.data_directory, file)
+
+    def open(self, file):
+        return Image.open(path.join(self.data_directory, file))
+
+    def load(self, file, size=None):
+        return load_image(self.open(file), size)
+
+class ArchiveStore():
+    """
+    Loads images straight from an uncompressed tar, or a zip, archive of the dataset, without extracting it.
+
+    The offsets of the archive's members are indexed once, in a sidecar file next to the archive, after which
+    members are read with `pread` on a single file handle per process, shared by its threads.
+
+    Args:
+        archive_file: tar or zip archive containing the dataset directories.
+    """
+    def __init__(self, archive_file: str) -> None:
+        self.archive_file = archive_file
+        self.members = get_member_index(archive_file)
+        self.prefix = find_prefix(self.members)
+        self.fd = None
+        self.fd_pid = None
+
+    def __contains__(self, file):
+        return self.prefix + file in self.members
+
+    def __getstate__(self):
+        # File handles stay with the process that opened them
+        state = self.__dict__.copy()
+        state['fd'] = None
+        state['fd_pid'] = None
+        return state
+
+    def __del__(self):
+        if getattr(self, 'fd', None) != None and self.fd_pid == getpid():
+            close(self.fd)
+
+    def get_fd(self):
+        if self.fd_pid != getpid():
+            # The first reads usually come at once from a pool of threads, only one of which should open the archive
+            with FD_LOCK:
+                if self.fd_pid != getpid():
+                    # Forked processes reopen the archive rather than share the parent's handle
+                    self.fd = open_fd(self.archive_file, O_RDONLY)
+                    self.fd_pid = getpid()
+        return self.fd
+
+    def read(self, file):
+        member = self.members.get(self.prefix + file)
+        if member == None:
+            raise FileNotFoundError("\"{}\" is not in the archive \"{}\".".format(file, self.archive_file))
+        offset, size, method = member
+        data = pread(self.get_fd(), size, offset)
+        if method == zipfile.ZIP_DEFLATED:
+            data = decompress(data, -15)
+        return data
+
+    def stat(self, file):
+        if file not in self:
+            raise FileNotFoundError("\"{}\" is not in the archive \"{}\".".format(file, self.archive_file))
+        return stat(self.archive_file).st_mtime_ns, self.members[self.prefix + file][1]
+
+    def sidecar(self, file):
+        return "{}.{}".format(self.archive_file, file.replace("/", "."))
+
+    def open(self, file):
+        return Image.open(BytesIO(self.read(file)))
+
+    def load(self, file, size=None):
+        return load_image(self.open(file), size)
+
+class MappedStore():
+    """
+    Base of the stores which serve samples from a memory mapped indexed file.
+    """
+    MAGIC = None
+    KIND = None
+
+    def __init__(self, file_name: str) -> None:
+        self.file_name = file_name
+        self.entries = read_indexed_file(file_name, self.MAGIC, self.KIND)
+        self.data = np.memmap(file_name, dtype=np.uint8, mode='r')
+
+    def __contains__(self, file):
+        return file in self.entries
+
+    def __getstate__(self):
+        # Don't pickle the mapped data, each process maps the file itself
+        state = self.__dict__.copy()
+        del state['data']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = np.memmap(self.file_name, dtype=np.uint8, mode='r')
+
+class PackedStore(MappedStore):
+    """
+    Serves decoded images as zero-copy views over a memory mapped pack file.
+
+    Args:
+        pack_file: pack file written by `ecadataset pack`.
+    """
+    MAGIC = b"ECAPACK1"
+    KIND = "pack"
+
+    def load(self, file, size=None):
+        offset, shape = self.entries[file]
+        size = int(np.prod(shape))
+        return self.data[offset:offset+size].reshape(shape)
+
+class BitMaskStore(MappedStore):
+    """
+    Serves binary masks from a memory mapped file of bit-packed, optionally run-length encoded, masks.
+
+    Masks are unpacked to bool arrays, and crops are unpacked straight from the packed rows they cover.
+
+    Args:
+        mask_file: mask file written by `ecadataset pack-masks`.
+    """
+    MAGIC = b"ECAMASK1"
+    KIND = "mask"
+
+    def load(self, file, size=None):
+        return self.load_crop(file, None)
+
+    def load_crop(self, file, crop):
+        offset, (height, width, encoding, run_count) = self.entries[file]
+        left, top, right, bottom = (0, 0, width, height) if crop == None else crop
+        right, bottom = min(right, width), min(bottom, height)
+
+        if encoding == "rle":
+            words = self.data[offset:offset + 4 * (height + 1 + run_count)].view(np.uint32)
+            rows = decode_runs(words[:height + 1], words[height + 1:], top, bottom, width)
+            return rows[:, left:right]
+
+        packed_width = (width + 7) // 8
+        rows = self.data[offset:offset + height * packed_width].reshape(height, packed_width)
+        rows = np.unpackbits(rows[top:bottom, left // 8:(right + 7) // 8], axis=1)
+        return rows[:, left % 8:left % 8 + right - left].view(bool)
+
+# ========================================
+# Some helper methods...
+
+FD_LOCK = Lock()
+
+def reset_fd_lock():
+    # A forked process may have been copied while another thread held the lock
+    global FD_LOCK
+    FD_LOCK = Lock()
+
+register_at_fork(after_in_child=reset_fd_lock)
+
+def open_store(data_directory):
+    """
+    Store for the files of the dataset, read from an archive if the data directory is a tar or zip file.
+    """
+    if path.isfile(data_directory):
+        return ArchiveStore(data_directory)
+    return FileStore(data_directory)
+
+def load_image(image, size):
+    if size != None:
+        # Formats which support it, such as JPEG, decode straight to a reduced scale no smaller than size
+        image.draft(image.mode, size)
+    image.load()
+    return image
+
+MEMBER_INDEX_VERSION = 1
+
+def get_member_index(archive_file):
+    archive_stat = stat(archive_file)
+    key = [MEMBER_INDEX_VERSION, archive_stat.st_mtime_ns, archive_stat.st_size]
+    index_file = archive_file + ".members.json"
+    try:
+        with open(index_file) as file:
+            index = loads(file.read())
+        if index['key'] == key:
+            return {name: tuple(member) for name, member in index['members'].items()}
+    except (OSError, ValueError, KeyError):
+        pass
+
+    members = read_members(archive_file)
+    temp_file = "{}.{}.tmp".format(index_file, getpid())
+    try:
+        with open(temp_file, "w") as file:
+            file.write(dumps({'key': key, 'members': members}))
+        replace(temp_file, index_file)
+    except OSError:
+        # Read-only archives simply index their members on each load
+        pass
+    return members
+
+def read_members(archive_file):
+    # Members are indexed by the offset and size of their data, and how it is compressed
+    if zipfile.is_zipfile(archive_file):
+        members = {}
+        with zipfile.ZipFile(archive_file) as archive, open(archive_file, "rb") as file:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                    raise ValueError("\"{}\" uses an unsupported compression method.".format(archive_file))
+                # The data follows the member's local header, whose extra field may differ from the central directory's
+                file.seek(info.header_offset)
+                header = file.read(30)
+                name_length, extra_length = int.from_bytes(header[26:28], 'little'), int.from_bytes(header[28:30], 'little')
+                offset = info.header_offset + 30 + name_length + extra_length
+                members[info.filename] = (offset, info.compress_size, info.compress_type)
+        return members
+
+    try:
+        with tarfile.open(archive_file, "r:") as archive:
+            return {member.name: (member.offset_data, member.size, zipfile.ZIP_STORED) for member in archive if member.isfile()}
+    except tarfile.ReadError:
+        raise ValueError("\"{}\" is not a zip or uncompressed tar archive.".format(archive_file))
+
+def find_prefix(members):
+    # Archives may hold the dataset directories within a root directory
+    manifests = [name for name in members if name.endswith("/manifest.json")]
+    if len(manifests) == 0:
+        return ""
+    root = dirname(dirname(min(manifests, key=len)))
+    return root + "/" if root != "" else ""
+
+ALIGNMENT = 64
+
+def read_indexed_file(file_name, magic, kind):
+    with open(file_name, "rb") as file:
+        if file.read(len(magic)) != magic:
+            raise ValueError("\"{}\" is not an ECA {} file.".format(file_name, kind))
+        index_offset = int.from_bytes(file.read(8), 'little')
+        file.seek(index_offset)
+        entries = loads(file.read().decode())
+    return {name: (offset, tuple(info)) for name, (offset, info) in entries.items()}
+
+def read_indexed_data(data, magic, file_name, kind):
+    # As read_indexed_file, for a file already read whole
+    if data[:len(magic)] != magic:
+        raise ValueError("\"{}\" is not an ECA {} file.".format(file_name, kind))
+    index_offset = int.from_bytes(data[len(magic):len(magic) + 8], 'little')
+    entries = loads(bytes(data[index_offset:]).decode())
+    return {name: (offset, tuple(info)) for name, (offset, info) in entries.items()}
+
+def write_indexed_file(file_name, magic, items):
+    # Arrays are aligned so that they may be viewed as any dtype, and indexed by a trailing JSON table
+    entries = {}
+    with open(file_name, "wb") as file:
+        file.write(magic + bytes(8))
+        for name, array, info in items:
+            padding = -file.tell() % ALIGNMENT
+            file.write(bytes(padding))
+            entries[name] = (file.tell(), info)
+            file.write(np.ascontiguousarray(array).data)
+        index_offset = file.tell()
+        file.write(dumps(entries).encode())
+        file.seek(len(magic))
+        file.write(index_offset.to_bytes(8, 'little'))
+
+def write_pack(pack_file, files, load):
+    def items():
+        for name in files:
+            array = np.ascontiguousarray(load(name), dtype=np.uint8)
+            yield name, array, array.shape
+    write_indexed_file(pack_file, PackedStore.MAGIC, items())
+
+def encode_runs(mask):
+    # Each row is encoded separately as alternating runs of zeros and ones, starting with zeros
+    height, width = mask.shape
+    padded = np.zeros((height, width + 1), dtype=np.int8)
+    padded[:, 1:] = mask
+    rows, columns = np.nonzero(np.diff(padded, axis=1))
+    change_counts = np.bincount(rows, minlength=height)
+    row_offsets = np.concatenate([[0], np.cumsum(change_counts + 1)])
+    # The k-th change of a row ends its k-th run and starts the following one
+    ranks = np.arange(len(rows)) - (np.cumsum(change_counts) - change_counts)[rows]
+    positions = row_offsets[rows] + ranks
+    starts = np.zeros(row_offsets[-1], dtype=np.int64)
+    ends = np.full(row_offsets[-1], width, dtype=np.int64)
+    ends[positions] = columns
+    starts[positions + 1] = columns
+    return row_offsets.astype(np.uint32), (ends - starts).astype(np.uint32)
+
+def decode_runs(row_offsets, runs, top, bottom, width):
+    start = row_offsets[top]
+    runs = runs[start:row_offsets[bottom]]
+    run_counts = np.diff(row_offsets[top:bottom + 1].astype(np.int64))
+    # Runs alternate between zeros and ones from the start of each row
+    values = (np.arange(len(runs)) - np.repeat(row_offsets[top:bottom] - start, run_counts)) % 2 == 1
+    return np.repeat(values, runs).reshape(bottom - top, width)
+
+def write_masks(mask_file, files, load, rle=False):
+    def items():
+        for name in files:
+            mask = np.asarray(load(name), dtype=bool)
+            height, width = mask.shape
+            if rle:
+                row_offsets, runs = encode_runs(mask)
+                yield name, np.concatenate([row_offsets, runs]), (height, width, "rle", len(runs))
+            else:
+                yield name, np.packbits(mask, axis=1), (height, width, "bits", 0)
+    write_indexed_file(mask_file, BitMaskStore.MAGIC, items())
+
+def pack_dataset(dataset, pack_file):
+    """
+    Writes the decoded frames and masks of a dataset into a single pack file.
+
+    Args:
+        dataset: the ECADataset to pack.
+        pack_file: path of the pack file to write.
+    """
+    frames = set(dataset.sample_list.image_files.tolist())
+    masks = dataset.sample_list.mask_files.tolist()
+    store = dataset.file_store
+
+    def load(file):
+        image = store.load(file)
+        return np.asarray(image.convert("RGB" if file in frames else "L"))
+
+    write_pack(pack_file, [*dataset.sample_list.image_files.tolist(), *masks], load)
+
+def pack_masks(dataset, mask_file, rle=False):
+    """
+    Writes the masks of a dataset into a single file of bit-packed masks.
+
+    Args:
+        dataset: the ECADataset whose masks to pack.
+        mask_file: path of the mask file to write.
+        rle: whether to run-length encode the rows of each mask rather than store them as bits.
+    """
+    store = dataset.file_store
+
+    def load(file):
+        image = store.load(file)
+        return np.asarray(image.convert("L")) > 0
+
+    write_masks(mask_file, dataset.sample_list.mask_files.tolist(), load, rle)
@@ -0,0 +1,162 @@
+import numpy as np
+from os import path, makedirs
+from glob import glob
+from io import BytesIO
+from collections import deque
+from typing import Optional, Sequence, Union
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from .dataset import AnnotationType, crop_image, frame_to_array, mask_to_array
+from .storage import read_indexed_data, write_indexed_file
+from .loading import prefetch_samples
+
+class ShardStream():
+    """
+    Streams samples from shards written by `ecadataset shard`, for training at scale.
+
+    Shards are read whole and in sequence, the next being read while the current one is consumed, so throughput
+    is bounded by disk bandwidth rather than seek latency. Encoded samples are shuffled within a buffer, then
+    decoded ahead of the consumer on a pool of threads. Each iteration is one pass over the shards, and when
+    shuffling, the order of the shards and the samples is drawn afresh from the stream's seed.
+
+    Args:
+        shards: directory of shards, or a list of shard files.
+        annotation_type: flag denoting the type of annotation(s) provided.
+        include_cropped: whether or not to include additional cropped samples.
+        include_source_info: whether or not to include the source information of the sample.
+        output: "pil" to return frames and masks as PIL images, or "numpy" for HWC uint8 frames and bool masks.
+        shuffle_buffer: number of samples to shuffle between, 0 streams samples in the order they were written.
+        seed: seed of the shuffling.
+        prefetch: maximum number of samples decoded ahead of the consumer.
+        num_workers: number of threads used to decode samples.
+    """
+    def __init__(
+        self,
+        shards: Union[str, Sequence[str]],
+        annotation_type: AnnotationType = AnnotationType.AREA,
+        include_cropped: bool = True,
+        include_source_info: bool = False,
+        output: str = "pil",
+        shuffle_buffer: int = 0,
+        seed: Optional[int] = None,
+        prefetch: int = 8,
+        num_workers: int = 4
+    ) -> None:
+        if isinstance(shards, str):
+            shards = sorted(glob(path.join(shards, "*" + SHARD_SUFFIX)))
+        if len(shards) == 0:
+            raise FileNotFoundError("No shards were found, write them with the command \"ecadataset shard\".")
+        if output not in ("pil", "numpy"):
+            raise ValueError("Invalid output \"{}\"! Options are \"pil\" and \"numpy\".".format(output))
+        self.shard_files = list(shards)
+        self.annotation_type = annotation_type
+        self.include_cropped = include_cropped
+        self.include_source_info = include_source_info
+        self.output = output
+        self.shuffle_buffer = shuffle_buffer
+        self.rng = np.random.default_rng(seed)
+        self.prefetch = prefetch
+        self.num_workers = num_workers
+
+    def __iter__(self):
+        shard_files = self.shard_files
+        if self.shuffle_buffer > 0:
+            shard_files = [shard_files[i] for i in self.rng.permutation(len(shard_files))]
+        records = read_records(shard_files, self.include_cropped)
+        if self.shuffle_buffer > 0:
+            records = shuffle_records(records, self.shuffle_buffer, self.rng)
+        return prefetch_samples(self.__decode, records, self.prefetch, self.num_workers)
+
+    def __decode(self, record):
+        frame_data, mask_data, content_area, source_info, crop = record
+
+        frame = decode_image(frame_data, crop)
+        result = (frame_to_array(frame) if self.output == "numpy" else frame,)
+
+        if AnnotationType.AREA in self.annotation_type:
+            result = (*result, content_area)
+
+        if AnnotationType.MASK in self.annotation_type:
+            mask = decode_image(mask_data, crop)
+            result = (*result, mask_to_array(mask) if self.output == "numpy" else mask)
+
+        if self.include_source_info:
+            result = (*result, source_info)
+
+        return result
+
+# ========================================
+# Some helper methods...
+
+SHARD_MAGIC = b"ECASHRD1"
+SHARD_SUFFIX = ".ecashard"
+
+def write_shards(view, shard_directory, shard_size=256):
+    """
+    Writes the encoded frames and masks of a dataset, with their annotations, into shards for streaming.
+
+    Args:
+        view: the ECADataset, or a view of it, to shard. Cropped samples are left out, as they are recreated
+            from their full samples when streaming.
+        shard_directory: directory to write the shards to.
+        shard_size: number of samples in each shard.
+    Returns:
+        list: the shard files written.
+    """
+    index = view.dataset.sample_list
+    store = view.dataset.file_store
+    rows = view.indices[~index.has_crop[view.indices]].tolist()
+    makedirs(shard_directory, exist_ok=True)
+
+    def items(rows):
+        for row in rows:
+            sample = index[row]
+            frame_data, mask_data = store.read(sample['image_file']), store.read(sample['mask_file'])
+            info = (len(frame_data), len(mask_data), sample['content_area'], sample['source_info'], sample['optimal_crop'])
+            yield str(row), np.frombuffer(frame_data + mask_data, dtype=np.uint8), info
+
+    shard_files = []
+    for start in range(0, len(rows), shard_size):
+        shard_file = path.join(shard_directory, "shard-{:05d}{}".format(len(shard_files), SHARD_SUFFIX))
+        write_indexed_file(shard_file, SHARD_MAGIC, items(rows[start:start + shard_size]))
+        shard_files.append(shard_file)
+    return shard_files
+
+def read_shard(shard_file):
+    with open(shard_file, "rb") as file:
+        data = file.read()
+    return memoryview(data), read_indexed_data(data, SHARD_MAGIC, shard_file, "shard")
+
+def read_records(shard_files, include_cropped):
+    # The next shard is read on a background thread while the current one is consumed
+    with ThreadPoolExecutor(1) as executor:
+        pending = deque(executor.submit(read_shard, shard_file) for shard_file in shard_files[:1])
+        for next_file in [*shard_files[1:], None]:
+            data, entries = pending.popleft().result()
+            if next_file != None:
+                pending.append(executor.submit(read_shard, next_file))
+            for offset, (frame_length, mask_length, content_area, source_info, optimal_crop) in entries.values():
+                frame_data = data[offset:offset + frame_length]
+                mask_data = data[offset + frame_length:offset + frame_length + mask_length]
+                yield frame_data, mask_data, content_area, source_info, None
+                if include_cropped and content_area != None:
+                    yield frame_data, mask_data, None, source_info, optimal_crop
+
+def shuffle_records(records, buffer_size, rng):
+    buffer = []
+    for record in records:
+        if len(buffer) < buffer_size:
+            buffer.append(record)
+            continue
+        index = int(rng.integers(buffer_size))
+        yield buffer[index]
+        buffer[index] = record
+    for index in rng.permutation(len(buffer)).tolist():
+        yield buffer[index]
+
+def decode_image(data, crop):
+    image = Image.open(BytesIO(data))
+    image.load()
+    if crop != None:
+        return crop_image(image, crop)
+    return image
@@ -0,0 +1,212 @@
+import numpy as np
+from asyncio import get_running_loop
+from typing import Optional, Sequence, Callable, Union
+from .loading import resolve_indices, load_batch, prefetch_samples, stream_samples, iterate_shared_memory
+
+class DatasetView():
+    """
+    Lazy view over a subset of the samples of an ECADataset.
+
+    A view only holds an array of indices into the dataset's sample list, so it is cheap to create and may be
+    iterated any number of times. Indexing with an integer loads a sample, a slice gives a nested view, and a
+    list, integer array or boolean mask loads a batch of samples.
+
+    Args:
+        dataset: the dataset being viewed.
+        indices: indices into the dataset's sample list.
+    """
+    def __init__(self, dataset, indices: np.ndarray) -> None:
+        self.dataset = dataset
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        for index in self.indices.tolist():
+            yield self.dataset._load_sample(index)
+
+    def __getitem__(self, key):
+
+        if isinstance(key, slice):
+            return DatasetView(self.dataset, self.indices[key])
+
+        if isinstance(key, (int, np.integer)):
+            return self.dataset._load_sample(int(self.indices[key]))
+
+        indices = self.indices[resolve_indices(key, len(self))]
+        return load_batch(self.dataset._load_sample, indices, self.dataset._get_executor())
+
+    def subset(self, key):
+        """
+        Lazy view of the samples selected by a list, integer array or boolean mask.
+        """
+        return DatasetView(self.dataset, self.indices[resolve_indices(key, len(self))])
+
+    def shard(self, rank: int, world_size: int, seed: Optional[int] = 0):
+        """
+        Lazy view of one of `world_size` disjoint partitions of the samples, balanced to within a few samples.
+
+        Samples of the same frame, such as a sample and its cropped twin, are kept next to each other in the same
+        partition, so that decoded frames are reused. The groups of samples are shuffled by the seed before being
+        split into contiguous partitions, so every rank given the same seed agrees on the partitioning. To also
+        shard across the loading workers of each rank, use `rank * num_workers + worker` out of
+        `world_size * num_workers` partitions.
+
+        Args:
+            rank: index of the partition, from 0 to world_size - 1.
+            world_size: number of partitions.
+            seed: seed of the shuffling of groups, None keeps the groups in their original order.
+        """
+        if not 0 <= rank < world_size:
+            raise ValueError("Invalid rank {}! The rank must be from 0 to {}.".format(rank, world_size - 1))
+
+        codes = self.dataset.sample_list.image_codes[self.indices]
+        _, first, groups, counts = np.unique(codes, return_index=True, return_inverse=True, return_counts=True)
+
+        # Groups are numbered by their first sample, rather than by their frame, to keep the order of the view
+        numbering = np.empty(len(first), dtype=np.int64)
+        numbering[np.argsort(first)] = np.arange(len(first))
+        groups, counts = numbering[groups], counts[np.argsort(first)]
+        order = np.arange(len(counts)) if seed == None else np.random.default_rng(seed).permutation(len(counts))
+        group_positions = np.empty(len(counts), dtype=np.int64)
+        group_positions[order] = np.arange(len(counts))
+
+        # Each group goes to the partition holding its midpoint in the shuffled sequence of samples
+        midpoints = np.cumsum(counts[order]) - counts[order] / 2
+        group_ranks = np.empty(len(counts), dtype=np.int64)
+        group_ranks[order] = np.minimum(midpoints * world_size // max(len(codes), 1), world_size - 1)
+
+        positions = np.flatnonzero(group_ranks[groups] == rank)
+        positions = positions[np.argsort(group_positions[groups[positions]], kind="stable")]
+        return DatasetView(self.dataset, self.indices[positions])
+
+    def iter(self, prefetch: int = 8, workers: Optional[int] = None, processes: bool = False):
+        """
+        Iterates over the samples, loading them ahead of the consumer on a pool of threads or processes.
+
+        Args:
+            prefetch: maximum number of samples loaded ahead of the consumer.
+            workers: number of loading threads or processes, defaults to the dataset's `num_workers`.
+            processes: whether to load in worker processes, see `SharedMemoryLoader`. Frames and masks are
+                then returned as numpy arrays which are only valid until the next sample is requested.
+        """
+        workers = self.dataset.num_workers if workers == None else workers
+        if processes:
+            return iterate_shared_memory(self.dataset, self.indices, prefetch, workers)
+        return prefetch_samples(self.dataset._load_sample, self.indices.tolist(), prefetch, workers)
+
+    async def aget(self, key: int):
+        """
+        Loads a sample on the dataset's thread pool, without blocking the event loop.
+        """
+        index = int(self.indices[key])
+        return await get_running_loop().run_in_executor(self.dataset._get_executor(), self.dataset._load_sample, index)
+
+    def astream(self, concurrency: int = 8):
+        """
+        Async iterator over the samples, loaded on the dataset's thread pool without blocking the event loop.
+
+        Args:
+            concurrency: maximum number of samples being loaded, or waiting to be consumed, at any time. Loads
+                beyond the dataset's `num_workers` queue on its thread pool. Closing the iterator cancels any loads
+                which have not yet started.
+        """
+        return stream_samples(self.dataset._load_sample, self.indices.tolist(), concurrency, self.dataset._get_executor())
+
+    def frame_size(self, key: int):
+        """
+        Size of the frame returned for a sample, as (height, width), without loading it.
+        """
+        height, width = self.dataset._frame_sizes(self.indices[[key]])[0].tolist()
+        return height, width
+
+    def frame_sizes(self):
+        """
+        (N, 2) array of the sizes of the frames returned for the samples, as (height, width), without loading them.
+        """
+        return self.dataset._frame_sizes(self.indices)
+
+    def metadata(self):
+        """
+        Metadata of the samples in the view as a dict of numpy columns.
+
+        Columns are "data_source" (DataSource flag values), "source", "video" and "frame" (the source information),
+        "circle" (content areas as (x, y, r), zero if absent), "has_area", "cropped", and "frame_size" (the size of
+        the returned frame as (height, width), after any cropping or scaling).
+        """
+        index = self.dataset.sample_list
+        rows = self.indices
+        return {
+            'data_source': index.data_sources[rows],
+            'source': index.source_names[index.source_codes[rows]],
+            'video': index.video_names[index.video_codes[rows]],
+            'frame': index.frame_numbers[rows],
+            'circle': index.circles[rows],
+            'has_area': index.has_area[rows],
+            'cropped': index.has_crop[rows],
+            'frame_size': self.frame_sizes(),
+        }
+
+    def filter(self, predicate: Union[Callable, np.ndarray]):
+        """
+        Lazy view of the samples matching a predicate.
+
+        Args:
+            predicate: function taking the `metadata` columns and returning a boolean mask, or the mask itself.
+        """
+        mask = predicate(self.metadata()) if callable(predicate) else predicate
+        return self.subset(mask)
+
+    def where(
+        self,
+        data_source = None,
+        sources: Optional[Sequence[str]] = None,
+        videos: Optional[Sequence[str]] = None,
+        frames: Optional[Sequence[int]] = None,
+        has_area: Optional[bool] = None,
+        cropped: Optional[bool] = None,
+        min_radius: Optional[int] = None,
+        max_radius: Optional[int] = None
+    ):
+        """
+        Lazy view of the samples matching all of the given conditions, evaluated over the index columns.
+
+        Args:
+            data_source: DataSource flag of the origin dataset(s) to keep.
+            sources: names of the source datasets, as in the source information, to keep.
+            videos: names of the source videos to keep.
+            frames: frame numbers to keep.
+            has_area: whether to keep samples with or without a content area.
+            cropped: whether to keep cropped or uncropped samples.
+            min_radius: minimum content area radius, samples without a content area are dropped.
+            max_radius: maximum content area radius, samples without a content area are dropped.
+        """
+        index = self.dataset.sample_list
+        rows = self.indices
+        mask = np.ones(len(rows), dtype=bool)
+
+        if data_source != None:
+            mask &= (index.data_sources[rows] & data_source.value) != 0
+        if sources != None:
+            mask &= table_mask(index.source_names, sources)[index.source_codes[rows]]
+        if videos != None:
+            mask &= table_mask(index.video_names, videos)[index.video_codes[rows]]
+        if frames != None:
+            mask &= np.isin(index.frame_numbers[rows], np.asarray(frames))
+        if has_area != None:
+            mask &= index.has_area[rows] == has_area
+        if cropped != None:
+            mask &= index.has_crop[rows] == cropped
+        if min_radius != None:
+            mask &= index.has_area[rows] & (index.circles[rows, 2] >= min_radius)
+        if max_radius != None:
+            mask &= index.has_area[rows] & (index.circles[rows, 2] <= max_radius)
+
+        return DatasetView(self.dataset, rows[mask])
+
+# ========================================
+# Some helper methods...
+
+def table_mask(table, names):
+    return np.isin(table, np.asarray(list(names), dtype=str))
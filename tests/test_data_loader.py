@@ -1,9 +1,25 @@
+import io
 import os
+import sys
+import subprocess
+import asyncio
+import json
+import tarfile
+import zipfile
+import time
+import tempfile
 import unittest
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from PIL import Image
 from typing import Sequence
 
-from ecadataset import ECADataset, DataSource, AnnotationType
+from ecadataset import ECADataset, DatasetView, ShardStream, Sampler, DataSource, AnnotationType, calculate_optimal_crop, calculate_optimal_crops
+from ecadataset.storage import ArchiveStore, pack_dataset, pack_masks
+from ecadataset.loading import SharedMemoryLoader, SEGMENT_REGISTRY, find_leaked_segments
+from multiprocessing.shared_memory import SharedMemory
+from ecadataset.streaming import write_shards
 
 CHOLEC_SAMPLE_COUNT = 3929
 ROBUST_SAMPLE_COUNT = 2994
@@ -43,3 +59,408 @@ class TestDataLoader(unittest.TestCase):
         subset = dataset[key]
         for sample, origin_index in zip(subset, indices):
             self.assertEqual(sample[2], dataset[origin_index][2])
+
+    def test_sample_index(self):
+        dataset = ECADataset(include_source_info=True)
+        rebuilt = ECADataset(include_source_info=True, rebuild_index=True)
+        self.assertEqual(list(dataset.sample_list), list(rebuilt.sample_list))
+        for sample in dataset.sample_list[::250]:
+            with Image.open(os.path.join(dataset.data_directory, sample['image_file'])) as image:
+                self.assertEqual(tuple(sample['frame_size']), image.size[::-1])
+
+    def test_packed_file(self):
+        dataset = ECADataset(annotation_type=AnnotationType.BOTH)
+        with tempfile.TemporaryDirectory() as directory:
+            pack_file = os.path.join(directory, "eca.pack")
+            pack_dataset(ECADataset(include_cropped=False), pack_file)
+            packed = ECADataset(annotation_type=AnnotationType.BOTH, packed_file=pack_file)
+            for index in range(0, len(dataset), 250):
+                image, area, mask = dataset[index]
+                packed_image, packed_area, packed_mask = packed[index]
+                self.assertEqual(area, packed_area)
+                self.assertTrue(np.array_equal(np.asarray(image.convert("RGB")), np.asarray(packed_image)))
+                self.assertTrue(np.array_equal(np.asarray(mask.convert("L")), np.asarray(packed_mask)))
+
+    def test_packed_masks(self):
+        dataset = ECADataset(annotation_type=AnnotationType.MASK, output="numpy")
+        with tempfile.TemporaryDirectory() as directory:
+            for rle in [False, True]:
+                mask_file = os.path.join(directory, "masks.pack")
+                pack_masks(ECADataset(include_cropped=False), mask_file, rle)
+                packed = ECADataset(annotation_type=AnnotationType.MASK, output="numpy", packed_masks=mask_file)
+                for index in range(0, len(dataset), 7):
+                    _, mask = dataset[index]
+                    _, packed_mask = packed[index]
+                    self.assertEqual(packed_mask.dtype, bool)
+                    self.assertTrue(np.array_equal(mask, packed_mask))
+
+                images = ECADataset(annotation_type=AnnotationType.MASK)
+                packed_images = ECADataset(annotation_type=AnnotationType.MASK, packed_masks=mask_file)
+                for index in [0, 1]:
+                    _, mask = images[index]
+                    _, packed_mask = packed_images[index]
+                    self.assertEqual(packed_mask.mode, mask.mode)
+                    self.assertTrue(np.array_equal(np.asarray(mask), np.asarray(packed_mask)))
+
+                scaled = ECADataset(annotation_type=AnnotationType.MASK, packed_masks=mask_file, scale=0.5)
+                image, mask = scaled[1]
+                self.assertEqual(image.size, mask.size)
+                self.assertEqual(mask.mode, "L")
+                _, file_mask = ECADataset(annotation_type=AnnotationType.MASK, scale=0.5)[1]
+                self.assertTrue(np.array_equal(np.asarray(mask), np.asarray(file_mask)))
+
+    def test_archives(self):
+        dataset = ECADataset(annotation_type=AnnotationType.BOTH, include_cropped=False, include_source_info=True)
+        with tempfile.TemporaryDirectory() as directory:
+            # Archive the first few samples of each manifest, within a root directory
+            members = {}
+            for name in ["cholec-eca", "robust-eca"]:
+                with open(os.path.join(dataset.data_directory, name, "manifest.json")) as file:
+                    samples = json.load(file)[:10]
+                members["eca-data/{}/manifest.json".format(name)] = json.dumps(samples).encode()
+                for sample in samples:
+                    for file in [sample['image_file'], sample['mask_file']]:
+                        with open(os.path.join(dataset.data_directory, file), "rb") as data:
+                            members["eca-data/" + file] = data.read()
+
+            tar_file = os.path.join(directory, "eca.tar")
+            with tarfile.open(tar_file, "w") as archive:
+                for name, data in members.items():
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    archive.addfile(info, io.BytesIO(data))
+            zip_file = os.path.join(directory, "eca.zip")
+            with zipfile.ZipFile(zip_file, "w") as archive:
+                for index, (name, data) in enumerate(members.items()):
+                    archive.writestr(name, data, zipfile.ZIP_DEFLATED if index % 2 else zipfile.ZIP_STORED)
+
+            for archive_file in [tar_file, zip_file]:
+                archived = ECADataset(archive_file, annotation_type=AnnotationType.BOTH, include_cropped=False, include_source_info=True)
+                self.assertEqual(len(archived), 20)
+                self.assertTrue(os.path.exists(archive_file + ".members.json"))
+                for image, area, mask, info in archived:
+                    index = dataset.where(sources=[info[0]], videos=[info[1]], frames=[info[2]]).indices[0]
+                    original_image, original_area, original_mask, _ = dataset[int(index)]
+                    self.assertEqual(area, original_area)
+                    self.assertEqual(image.tobytes(), original_image.tobytes())
+                    self.assertEqual(mask.tobytes(), original_mask.tobytes())
+
+            # Threads racing to make the first read share a single handle
+            store = ArchiveStore(tar_file)
+            opened = []
+            def slow_open(*args):
+                time.sleep(0.01)
+                opened.append(os.open(*args))
+                return opened[-1]
+            with mock.patch("ecadataset.storage.open_fd", slow_open), ThreadPoolExecutor(8) as executor:
+                fds = set(executor.map(lambda _: store.get_fd(), range(8)))
+            self.assertEqual(len(opened), 1)
+            self.assertEqual(fds, set(opened))
+            del store
+
+    def test_shard_streaming(self):
+        source = ECADataset(include_cropped=False)[:40]
+        with tempfile.TemporaryDirectory() as directory:
+            shard_files = write_shards(source, directory, shard_size=16)
+            self.assertEqual(len(shard_files), 3)
+
+            # Cropped samples directly follow their full samples, as in the dataset
+            dataset = ECADataset(annotation_type=AnnotationType.BOTH, include_source_info=True, output="numpy")
+            dataset = dataset[:40 + sum(area != None for _, area in source)]
+            stream = ShardStream(directory, annotation_type=AnnotationType.BOTH, include_source_info=True, output="numpy")
+            samples = list(stream)
+            self.assertEqual(len(samples), len(dataset))
+            for sample, original in zip(samples, dataset):
+                self.assertEqual(sample[1], original[1])
+                self.assertEqual(sample[3], original[3])
+                self.assertTrue(np.array_equal(sample[0], original[0]))
+                self.assertTrue(np.array_equal(sample[2], original[2]))
+
+            shuffled = ShardStream(directory, include_source_info=True, shuffle_buffer=32, seed=0)
+            expected = [(tuple(sample[3]), sample[1]) for sample in dataset]
+            order = [(tuple(info), area) for _, area, info in shuffled]
+            self.assertNotEqual(order, expected)
+            self.assertEqual(sorted(order, key=str), sorted(expected, key=str))
+            self.assertNotEqual(order, [(tuple(info), area) for _, area, info in shuffled])
+
+    def test_image_cache(self):
+        dataset = ECADataset(annotation_type=AnnotationType.BOTH)
+        cached = ECADataset(annotation_type=AnnotationType.BOTH, cache_size=256 * 1024 * 1024)
+        for index in range(100):
+            image, area, mask = dataset[index]
+            cached_image, cached_area, cached_mask = cached[index]
+            self.assertEqual(area, cached_area)
+            self.assertEqual(image.tobytes(), cached_image.tobytes())
+            self.assertEqual(mask.tobytes(), cached_mask.tobytes())
+        self.assertGreater(cached.cache.hits, 0)
+        self.assertLessEqual(cached.cache.current_bytes, cached.cache.max_bytes)
+
+        small = ECADataset(cache_size=16 * 1024 * 1024)
+        for _ in small[:100]:
+            pass
+        self.assertGreater(small.cache.evictions, 0)
+        self.assertLessEqual(small.cache.current_bytes, small.cache.max_bytes)
+
+    def test_batch_indexing(self):
+        dataset = ECADataset(include_source_info=True, num_workers=4)
+        indices = [5, 0, 17, 5, -1]
+        batch = dataset[indices]
+        self.assertEqual(len(batch), len(indices))
+        for sample, index in zip(batch, indices):
+            self.assertEqual(sample[2], dataset[index][2])
+            self.assertEqual(sample[0].tobytes(), dataset[index][0].tobytes())
+
+        mask = np.zeros(len(dataset), dtype=bool)
+        mask[[3, 9, 12]] = True
+        self.assertEqual([sample[2] for sample in dataset[mask]], [dataset[i][2] for i in [3, 9, 12]])
+        self.assertEqual(dataset[np.array([], dtype=int)], [])
+        with self.assertRaises(IndexError):
+            dataset[[len(dataset)]]
+
+    def test_views(self):
+        dataset = ECADataset(include_source_info=True)
+        view = dataset[10:100:3]
+        self.assertIsInstance(view, DatasetView)
+        self.assertEqual(len(view), len(range(10, 100, 3)))
+        self.assertEqual([s[2] for s in view], [s[2] for s in view])
+
+        nested = view[2:20:2]
+        indices = list(range(10, 100, 3))[2:20:2]
+        self.assertEqual(len(nested), len(indices))
+        for sample, index in zip(nested, indices):
+            self.assertEqual(sample[2], dataset[index][2])
+        self.assertEqual(nested[-1][2], dataset[indices[-1]][2])
+
+        subset = nested.subset([3, 0])
+        self.assertEqual([s[2] for s in subset], [dataset[indices[3]][2], dataset[indices[0]][2]])
+        self.assertEqual([s[2] for s in nested[[3, 0]]], [s[2] for s in subset])
+
+    def test_prefetching(self):
+        dataset = ECADataset(include_source_info=True)
+        view = dataset[:50]
+        self.assertEqual([s[2] for s in view.iter(prefetch=4, workers=2)], [s[2] for s in view])
+
+        iterator = view.iter(prefetch=4, workers=2)
+        next(iterator)
+        iterator.close()
+
+        missing = dataset.sample_list[3]['image_file']
+        first = min(i for i in range(10) if dataset.sample_list[i]['image_file'] == missing)
+        load = dataset.store.load
+        dataset.store.load = lambda file, size=None: load("missing.png" if file == missing else file, size)
+        iterator = dataset[:10].iter(prefetch=4, workers=2)
+        for _ in range(first):
+            next(iterator)
+        with self.assertRaises(FileNotFoundError):
+            next(iterator)
+
+    def test_async_loading(self):
+        dataset = ECADataset(include_source_info=True, num_workers=2)
+        view = dataset[:20]
+
+        async def run():
+            sample = await view.aget(-1)
+            self.assertEqual(sample[2], dataset[19][2])
+
+            # Other coroutines keep running while samples load
+            ticks = []
+            async def tick():
+                while True:
+                    ticks.append(None)
+                    await asyncio.sleep(0)
+            ticker = asyncio.create_task(tick())
+            infos = [sample[2] async for sample in view.astream(concurrency=4)]
+            ticker.cancel()
+            self.assertEqual(infos, [sample[2] for sample in view])
+            self.assertGreater(len(ticks), 1)
+
+            stream = view.astream(concurrency=4)
+            await stream.__anext__()
+            await stream.aclose()
+
+        asyncio.run(run())
+
+    def test_process_loading(self):
+        dataset = ECADataset(annotation_type=AnnotationType.BOTH, include_source_info=True)
+        view = dataset[:40]
+        for (image, area, mask, info), (shared_image, shared_area, shared_mask, shared_info) in zip(view, view.iter(prefetch=4, workers=2, processes=True)):
+            self.assertIsInstance(shared_image, np.ndarray)
+            self.assertTrue(np.array_equal(np.asarray(image.convert("RGB")), shared_image))
+            self.assertTrue(np.array_equal(np.asarray(mask.convert("L")) > 0, shared_mask))
+            self.assertEqual(area, shared_area)
+            self.assertEqual(info, shared_info)
+
+        with SharedMemoryLoader(dataset, workers=2, slots=2) as loader:
+            next(loader.load(view.indices))
+            names = loader.segment_names
+        self.assertEqual(find_leaked_segments(names), [])
+
+        # Segments recorded by a process which died without closing its loader are released by the next loader
+        process = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+        stale = SharedMemory(create=True, size=1024)
+        stale.close()
+        os.makedirs(SEGMENT_REGISTRY, exist_ok=True)
+        with open(os.path.join(SEGMENT_REGISTRY, "{}-{}.json".format(int(process.stdout), stale.name)), "w") as file:
+            json.dump([stale.name], file)
+
+        # Other files in the registry, including one cut short, are skipped
+        stray_files = [os.path.join(SEGMENT_REGISTRY, name) for name in ["stray.txt", "stray-file.json"]]
+        stray_files.append(os.path.join(SEGMENT_REGISTRY, "{}-truncated.json".format(int(process.stdout))))
+        for stray_file in stray_files:
+            with open(stray_file, "w") as file:
+                file.write('["trunc')
+        try:
+            with self.assertWarns(ResourceWarning):
+                SharedMemoryLoader(dataset, workers=1, slots=1).close()
+            self.assertEqual(find_leaked_segments([stale.name]), [])
+        finally:
+            for stray_file in stray_files:
+                os.remove(stray_file)
+
+    def test_numpy_output(self):
+        dataset = ECADataset(annotation_type=AnnotationType.BOTH)
+        arrays = ECADataset(annotation_type=AnnotationType.BOTH, output="numpy")
+        out_frame = np.zeros((1080, 1920, 3), dtype=np.uint8)
+        out_mask = np.zeros((1080, 1920), dtype=np.uint8)
+        for index in range(0, len(dataset), 250):
+            image, area, mask = dataset[index]
+            array_image, array_area, array_mask = arrays[index]
+            self.assertEqual(array_image.dtype, np.uint8)
+            self.assertEqual(array_image.shape, (image.height, image.width, 3))
+            self.assertTrue(np.array_equal(np.asarray(image.convert("RGB")), array_image))
+            self.assertEqual(array_mask.dtype, bool)
+            self.assertTrue(np.array_equal(np.asarray(mask.convert("L")) > 0, array_mask))
+            self.assertEqual(area, array_area)
+
+            into_image, into_area, into_mask = arrays.load_into(index, out_frame, out_mask)
+            self.assertTrue(np.shares_memory(into_image, out_frame))
+            self.assertTrue(np.shares_memory(into_mask, out_mask))
+            self.assertTrue(np.array_equal(into_image, array_image))
+            self.assertTrue(np.array_equal(into_mask, array_mask))
+
+    def test_reduced_resolution(self):
+        dataset = ECADataset(annotation_type=AnnotationType.BOTH)
+        halved = ECADataset(annotation_type=AnnotationType.BOTH, scale=0.5)
+        limited = ECADataset(annotation_type=AnnotationType.BOTH, max_size=320)
+        for index in range(0, len(dataset), 250):
+            image, area, mask = dataset[index]
+            halved_image, halved_area, halved_mask = halved[index]
+            self.assertAlmostEqual(halved_image.width, image.width / 2, delta=1)
+            self.assertAlmostEqual(halved_image.height, image.height / 2, delta=1)
+            self.assertEqual(halved_image.size, halved_mask.size)
+            if area != None:
+                for value, halved_value in zip(area, halved_area):
+                    self.assertAlmostEqual(halved_value, value / 2, delta=1)
+
+            limited_image, limited_area, limited_mask = limited[index]
+            self.assertLessEqual(max(limited_image.size), 320)
+            self.assertEqual(limited_image.size, limited_mask.size)
+
+    def test_cropped_views(self):
+        dataset = ECADataset(annotation_type=AnnotationType.BOTH, output="numpy", cache_size=256 * 1024 * 1024)
+        for index in range(len(dataset) - 1):
+            if dataset.sample_list[index + 1]['crop'] == None:
+                continue
+            image, _, mask = dataset[index]
+            cropped_image, _, cropped_mask = dataset[index + 1]
+            self.assertTrue(np.shares_memory(image, cropped_image))
+            self.assertTrue(np.shares_memory(mask, cropped_mask))
+            self.assertFalse(cropped_image.flags.writeable)
+            left, top, right, bottom = dataset.sample_list[index + 1]['crop']
+            self.assertTrue(np.array_equal(image[top:bottom, left:right], cropped_image))
+            break
+
+    def test_sharding(self):
+        dataset = ECADataset()
+        view = dataset[5:]
+        image_codes = dataset.sample_list.image_codes
+        for world_size in [1, 3, 4]:
+            shards = [view.shard(rank, world_size, seed=1) for rank in range(world_size)]
+            indices = np.concatenate([shard.indices for shard in shards])
+            self.assertEqual(sorted(indices.tolist()), view.indices.tolist())
+            self.assertLessEqual(max(map(len, shards)) - min(map(len, shards)), 2)
+            for shard in shards:
+                codes = image_codes[shard.indices]
+                # Samples of a frame are in one shard, and next to each other
+                self.assertEqual(len(np.unique(codes)), 1 + np.count_nonzero(codes[1:] != codes[:-1]))
+                self.assertFalse(np.isin(codes, image_codes[np.setdiff1d(indices, shard.indices)]).any())
+
+        self.assertEqual(view.shard(1, 3, seed=1).indices.tolist(), view.shard(1, 3, seed=1).indices.tolist())
+        self.assertNotEqual(view.shard(1, 3, seed=1).indices.tolist(), view.shard(1, 3, seed=2).indices.tolist())
+        self.assertEqual(view.shard(0, 1, seed=None).indices.tolist(), view.indices.tolist())
+        for reordered in [dataset.subset([10, 4, 0, 7]), dataset[::-1]]:
+            self.assertEqual(reordered.shard(0, 1, seed=None).indices.tolist(), reordered.indices.tolist())
+        with self.assertRaises(ValueError):
+            view.shard(3, 3)
+
+    def test_sampler(self):
+        dataset = ECADataset(include_source_info=True)
+        sampler = Sampler(dataset, seed=3, rank=1, world_size=2)
+        epoch = list(sampler)
+        self.assertEqual(epoch, dataset.shard(1, 2, seed=[3, 0]).indices.tolist())
+        self.assertEqual(sampler.epoch, 1)
+        self.assertNotEqual(list(sampler), epoch)
+
+        sampler.set_epoch(0)
+        iterator = iter(sampler)
+        first = [next(iterator) for _ in range(10)]
+        state = sampler.state_dict()
+        resumed = Sampler(dataset, seed=3, rank=1, world_size=2)
+        resumed.load_state_dict(state)
+        self.assertEqual(first + list(resumed), epoch)
+
+        resumed.load_state_dict(state)
+        samples = resumed.samples(prefetch=4, workers=2)
+        self.assertEqual(next(samples)[2], dataset[epoch[10]][2])
+        self.assertEqual(resumed.position, 11)
+        samples.close()
+        self.assertEqual([sample[2] for sample in resumed.samples()], [dataset[index][2] for index in epoch[11:]])
+        self.assertEqual((resumed.epoch, resumed.position), (1, 0))
+
+        self.assertEqual(list(Sampler(dataset, shuffle=False)), list(range(len(dataset))))
+        self.assertEqual(list(Sampler(dataset.subset([10, 4, 0, 7]), shuffle=False)), [10, 4, 0, 7])
+        self.assertEqual(list(Sampler(dataset[::-1], shuffle=False)), list(range(len(dataset)))[::-1])
+        with self.assertRaises(ValueError):
+            Sampler(dataset, seed=4, rank=1, world_size=2).load_state_dict(state)
+
+    def test_filtering(self):
+        dataset = ECADataset(include_source_info=True)
+        records = list(dataset.sample_list)
+        videos = sorted({record['source_info'][1] for record in records})[:2]
+
+        view = dataset.where(data_source=DataSource.ROBUST, videos=videos, min_radius=300)
+        expected = [
+            i for i, record in enumerate(records)
+            if record['image_file'].startswith("robust-eca") and record['source_info'][1] in videos
+            and record['content_area'] != None and record['content_area'][2] >= 300
+        ]
+        self.assertEqual(view.indices.tolist(), expected)
+
+        view = dataset[::2].where(cropped=True)
+        self.assertEqual(view.indices.tolist(), [i for i in range(0, len(records), 2) if records[i]['crop'] != None])
+
+        view = dataset.filter(lambda columns: (columns['frame'] % 2 == 0) & ~columns['has_area'])
+        expected = [i for i, record in enumerate(records) if record['source_info'][2] % 2 == 0 and record['content_area'] == None]
+        self.assertEqual(view.indices.tolist(), expected)
+
+    def test_optimal_crops(self):
+        rng = np.random.default_rng(0)
+        rectangles = rng.integers(100, 2000, (1000, 2))
+        circles = np.stack([
+            rng.integers(-200, rectangles[:, 0] + 200),
+            rng.integers(-200, rectangles[:, 1] + 200),
+            rng.integers(10, rectangles.max(axis=1)),
+        ], axis=1)
+        crops = calculate_optimal_crops(circles, rectangles)
+        self.assertEqual(crops.shape, (1000, 4))
+        for circle, rectangle, crop in zip(circles.tolist(), rectangles.tolist(), crops.tolist()):
+            self.assertEqual(tuple(crop), calculate_optimal_crop(circle, rectangle))
+
+    def test_frame_sizes(self):
+        for dataset in [ECADataset(), ECADataset(scale=0.3), ECADataset(max_size=250)]:
+            frame_sizes = dataset.frame_sizes()
+            self.assertEqual(frame_sizes.shape, (len(dataset), 2))
+            view = dataset[::50]
+            for i, (image, _) in enumerate(view):
+                self.assertEqual(view.frame_size(i), (image.height, image.width))
+                self.assertEqual(tuple(view.frame_sizes()[i]), (image.height, image.width))
@@ -4,7 +4,8 @@ from parameterized import parameterized
 import surface_distance
 import numpy as np
 
-from ecadataset import content_area_hausdorff
+from ecadataset import content_area_hausdorff, content_area_hausdorff_batch
+from ecadataset.scoring import make_polygon
 
 TEST_PARAMETERS = [
     (None, None, (270, 480)),
@@ -13,6 +14,14 @@ TEST_PARAMETERS = [
     ((0, 240, 300), (50, 240, 200), (270, 480)),
 ]
 
+# Nearly equal circles, whose distance is nearly the same all the way round
+NEAR_MISS_PARAMETERS = [
+    ((960, 540, 540), (960, 540, 541), (1080, 1920)),
+    ((960, 540, 520), (960, 540, 521), (1080, 1920)),
+    ((960, 540, 520), (963, 538, 520), (1080, 1920)),
+    ((960, 540, 520), (958, 543, 517), (1080, 1920)),
+]
+
 def compute_baseline_distance(circle_a, circle_b, frame_size):
     def draw_mask(circle, frame_size):
         if circle == None:
@@ -37,3 +46,52 @@ class TestHausdorffDistance(unittest.TestCase):
         score, _ = content_area_hausdorff(circle_a, circle_b, frame_size, normalise=False)
         one_percent = score / 100
         self.assertAlmostEqual(score, baseline, delta=one_percent)
+
+    @parameterized.expand(TEST_PARAMETERS[1:])
+    def test_best_pair(self, circle_a, circle_b, frame_size):
+        score, (point_a, point_b) = content_area_hausdorff(circle_a, circle_b, frame_size, normalise=False)
+        self.assertAlmostEqual(score, np.linalg.norm(np.subtract(point_a, point_b)))
+
+    @parameterized.expand(TEST_PARAMETERS)
+    def test_exact(self, circle_a, circle_b, frame_size):
+        score, _ = content_area_hausdorff(circle_a, circle_b, frame_size, exact=True)
+        dense_score, _ = content_area_hausdorff(circle_a, circle_b, frame_size, n_points=10000)
+        self.assertGreaterEqual(score, dense_score - 1e-9)
+        self.assertAlmostEqual(score, dense_score, delta=1e-3)
+
+    @parameterized.expand(TEST_PARAMETERS + NEAR_MISS_PARAMETERS)
+    def test_tolerance(self, circle_a, circle_b, frame_size):
+        exact_score, _ = content_area_hausdorff(circle_a, circle_b, frame_size, exact=True)
+        for tolerance in [1.0, 0.1, 0.01, 1e-3, 1e-6]:
+            score, _, error = content_area_hausdorff(circle_a, circle_b, frame_size, tolerance=tolerance)
+            self.assertLessEqual(error, tolerance)
+            self.assertLessEqual(score, exact_score + 1e-9)
+            self.assertGreaterEqual(score + error, exact_score - 1e-9)
+
+    @parameterized.expand([(None, (270, 480)), ((135, 240, 100), (270, 480)), ((240, 135, 100), (270, 480))])
+    def test_boundary(self, circle, frame_size):
+        boundary = make_polygon(frame_size, circle)
+        t = np.linspace(0, 1, 5)[:, None] * np.ones(len(boundary))
+        points = boundary.get_points(t)
+        closest = boundary.get_closest_points(points)
+        np.testing.assert_allclose(closest[:, np.arange(len(boundary)), np.arange(len(boundary))], points, atol=1e-9)
+        np.testing.assert_allclose(points[-1], np.roll(points[0], -1, axis=0), atol=1e-9)
+        if circle == None:
+            self.assertAlmostEqual(boundary.get_lengths().sum(), 2 * sum(frame_size))
+        elif len(boundary) == 1:
+            self.assertAlmostEqual(boundary.get_lengths().sum(), 2 * np.pi * circle[2])
+
+    def test_batch(self):
+        circles_a = [circle_a for circle_a, _, _ in TEST_PARAMETERS]
+        circles_b = [circle_b for _, circle_b, _ in TEST_PARAMETERS]
+        frame_sizes = [frame_size for _, _, frame_size in TEST_PARAMETERS]
+        scores, pairs = content_area_hausdorff_batch(circles_a, circles_b, frame_sizes, return_pairs=True)
+        for score, pair, parameters in zip(scores, pairs, TEST_PARAMETERS):
+            expected_score, expected_pair = content_area_hausdorff(*parameters)
+            self.assertAlmostEqual(score, expected_score)
+            if expected_pair != None:
+                np.testing.assert_allclose(pair, expected_pair)
+
+        nan_circles = np.array([(np.nan, np.nan, np.nan) if circle == None else circle for circle in circles_a], dtype=float)
+        nan_scores = content_area_hausdorff_batch(nan_circles, circles_b, frame_sizes)
+        np.testing.assert_allclose(nan_scores, scores)